@@ -8,108 +8,268 @@ to prevent them from appearing in Claude Code's /resume command.
 """
 
 import os
+import re
 import tempfile
 import shutil
 from contextlib import contextmanager
-from typing import List, Dict, Any, Optional
+from types import MappingProxyType
+from typing import List, Dict, Any, Iterable, Mapping, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Pattern to match [Image #N] or [Image: path]
+# ([^\]]+ also covers the "#N" form)
+_IMAGE_PLACEHOLDER_RE = re.compile(r'\[Image[:\s]+[^\]]+\]', re.ASCII)
+# Same pattern for _has_image_joined(): NUL is excluded so a match can never
+# span the separator between two texts
+_JOINED_IMAGE_PLACEHOLDER_RE = re.compile(r'\[Image[:\s]+[^\]\x00]+\]', re.ASCII)
 
-class ChatMode:
-    """Core chat mode functionality."""
-    
-    @staticmethod
-    def get_allowed_tools() -> List[str]:
-        """Get the list of tools allowed in chat mode."""
-        # Only web-based tools - no file system access
-        return ["WebSearch", "WebFetch"]
-    
-    @staticmethod
-    def get_allowed_tools_for_request(messages: List[Dict[str, Any]]) -> List[str]:
-        """
-        Determine allowed tools based on message content.
-        
-        Args:
-            messages: List of message dictionaries from the request
-            
-        Returns:
-            List of allowed tools based on message content
-        """
-        
-        # Start with base chat mode tools
-        base_tools = ["WebSearch", "WebFetch"]
-        
-        # Check if any message contains images
-        has_images = ChatMode._check_messages_for_images(messages)
-        
-        if has_images:
-            # Enable Read tool for image analysis
-            logger.info("Images detected in chat mode - temporarily enabling Read tool for image analysis")
-            return base_tools + ["Read"]
-        
-        return base_tools
+# Conversations longer than this are scanned with one regex pass over the
+# joined text instead of one pass per message
+_IMAGE_SCAN_JOIN_THRESHOLD = 32
+
+# Only web-based tools - no file system access
+_BASE_TOOLS = ("WebSearch", "WebFetch")
+# Read is enabled temporarily so image placeholders can be analyzed
+_BASE_TOOLS_WITH_READ = _BASE_TOOLS + ("Read",)
+
+# Variables that might reveal system paths
+_SENSITIVE_ENV_VARS = ('PWD', 'OLDPWD', 'HOME', 'USER', 'LOGNAME')
+_SENSITIVE_ENV_SET = frozenset(_SENSITIVE_ENV_VARS)
+# Claude-specific variables that might contain paths (CLAUDE_*DIR*)
+_CLAUDE_ENV_PREFIX = 'CLAUDE_'
+
+# Resolved once; sandboxes are only ever created under this directory
+_TEMP_DIR = tempfile.gettempdir()
+
+# Sandbox directory paths in CLI output, fused into one alternation so each
+# text is scanned once. Matches paths like:
+# /private/var/folders/.../claude_chat_sandbox_xxx or /tmp/claude_chat_sandbox_xxx
+_SANDBOX_PATH_RE = re.compile(
+    r'/private/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+'
+    r'|/tmp/claude_chat_sandbox_[a-zA-Z0-9_]+'
+    r'|/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+'
+    r'|claude_chat_sandbox_[a-zA-Z0-9_]+',
+    re.IGNORECASE
+)
+# Any leftover whitespace-delimited token mentioning the sandbox. Kept as a
+# second pass: inside the alternation its leading [^\s]* would win the
+# leftmost match and swallow text before the paths above.
+_SANDBOX_TOKEN_RE = re.compile(r'[^\s]*claude_chat_sandbox[^\s]*', re.IGNORECASE)
+_SANDBOX_PATH_REPLACEMENT = "my secure digital workspace (a sandboxed environment with no file system access)"
+
+# Phrases that might indicate directory exploration (only replaced once a
+# sandbox path was found), fused into one alternation. The lookahead keeps the
+# "current view" phrase from claiming text that the more specific "I will list
+# the files in this directory." phrase should replace. No phrase needs the
+# sandbox name: the passes above have already replaced every occurrence of it.
+_DIRECTORY_PHRASE_RE = re.compile(
+    r"The directory is empty\."
+    r"|I will list the files in this directory\."
+    r"|To give you a current view, I will list the files(?! in this directory\.)"
+    r"|listing the files in this directory",
+    re.IGNORECASE
+)
+_DIRECTORY_PHRASE_REPLACEMENT = (
+    "I'm operating in a secure digital black hole with no file system access. "
+    "Think of it as a void where files fear to tread!"
+)
+
+# Any other temp directory references (one fused pass)
+_TEMP_PATH_RE = re.compile(
+    r'/tmp/[a-zA-Z0-9_/]+'
+    r'|/private/var/folders/[a-zA-Z0-9_/]+'
+    r'|/var/folders/[a-zA-Z0-9_/]+'
+)
+_TEMP_PATH_REPLACEMENT = "my secure sandbox environment"
+
+# Read-only get_chat_mode_info() results; only "enabled" differs
+_CHAT_MODE_INFO_ENABLED = MappingProxyType({
+    "enabled": True,
+    "allowed_tools": _BASE_TOOLS,
+    "sandbox_enabled": True,
+    "sessions_disabled": True,
+    "file_operations_disabled": True
+})
+_CHAT_MODE_INFO_DISABLED = MappingProxyType({**_CHAT_MODE_INFO_ENABLED, "enabled": False})
+
+
+def _has_image_placeholder(text: str) -> bool:
+    """Check text for an image placeholder."""
+    return '[Image' in text and _IMAGE_PLACEHOLDER_RE.search(text) is not None
+
+
+def _iter_image_hits(messages: List[Dict[str, Any]]):
+    """Yield True for every image reference found in the messages.
     
-    @staticmethod
-    def _check_messages_for_images(messages: List[Dict[str, Any]]) -> bool:
-        """
-        Check if any message in the conversation contains images.
-        
-        This checks for:
-        1. OpenAI-format image_url content parts
-        2. File-based image placeholders like [Image #1]
-        
-        Args:
-            messages: List of message dictionaries
-            
-        Returns:
-            True if images are found, False otherwise
-        """
-        import re
+    Driven by any() in ChatMode._check_messages_for_images so the scan
+    stops at the first hit.
+    """
+    for message in messages:
+        content = message.get('content')
         
-        # Pattern to match [Image #N] or [Image: path]
-        image_placeholder_pattern = re.compile(r'\[Image[:\s]+(?:#\d+|[^]]+)\]')
+        # Check string content for image placeholders
+        if isinstance(content, str):
+            if _has_image_placeholder(content):
+                logger.debug("Found image placeholder in string content: %.100s...", content)
+                yield True
         
-        for message in messages:
-            content = message.get('content', '')
-            
-            # Check for array content (multimodal messages with image_url)
-            if isinstance(content, list):
-                for part in content:
-                    if isinstance(part, dict) and part.get('type') == 'image_url':
-                        return True
-                    # Also check text parts for placeholders
-                    if isinstance(part, dict) and part.get('type') == 'text':
-                        text = part.get('text', '')
-                        if image_placeholder_pattern.search(text):
-                            logger.debug("Found image placeholder in text content part")
-                            return True
-            
-            # Check string content for image placeholders
-            elif isinstance(content, str):
-                if image_placeholder_pattern.search(content):
-                    logger.debug(f"Found image placeholder in string content: {content[:100]}...")
+        # Check for array content (multimodal messages with image_url)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                ptype = part.get('type')
+                if ptype == 'image_url':
+                    yield True
+                # Also check text parts for placeholders
+                elif ptype == 'text':
+                    text = part.get('text')
+                    if text and _has_image_placeholder(text):
+                        logger.debug("Found image placeholder in text content part")
+                        yield True
+
+
+def _has_image_joined(messages: List[Dict[str, Any]]) -> bool:
+    """Check long conversations for images with a single regex pass.
+    
+    image_url parts are detected inline while collecting text; all text is
+    then joined with NUL separators and searched once. Texts that contain
+    NUL themselves fall back to the per-text search.
+    """
+    texts = []
+    append = texts.append
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            append(content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                ptype = part.get('type')
+                if ptype == 'image_url':
                     return True
-        
+                if ptype == 'text':
+                    text = part.get('text')
+                    if text:
+                        append(text)
+    
+    joined = '\x00'.join(texts)
+    if '[Image' not in joined:
         return False
+    if joined.count('\x00') == len(texts) - 1:
+        found = _JOINED_IMAGE_PLACEHOLDER_RE.search(joined) is not None
+    else:
+        found = any(_has_image_placeholder(text) for text in texts)
+    if found:
+        logger.debug("Found image placeholder in conversation text")
+    return found
+
+
+def get_allowed_tools() -> List[str]:
+    """Get the list of tools allowed in chat mode."""
+    return list(_BASE_TOOLS)
+
+
+def get_allowed_tools_for_request(messages: List[Dict[str, Any]]) -> List[str]:
+    """
+    Determine allowed tools based on message content.
     
-    @staticmethod
-    def create_sandbox() -> str:
-        """Create a temporary sandbox directory for isolated execution."""
-        sandbox_dir = tempfile.mkdtemp(prefix="claude_chat_sandbox_")
-        logger.debug(f"Created sandbox directory: {sandbox_dir}")
-        return sandbox_dir
+    Args:
+        messages: List of message dictionaries from the request
+        
+    Returns:
+        List of allowed tools based on message content
+    """
+    if check_messages_for_images(messages):
+        # Enable Read tool for image analysis
+        logger.info("Images detected in chat mode - temporarily enabling Read tool for image analysis")
+        return list(_BASE_TOOLS_WITH_READ)
+    
+    return list(_BASE_TOOLS)
+
+
+def check_messages_for_images(messages: List[Dict[str, Any]]) -> bool:
+    """
+    Check if any message in the conversation contains images.
     
-    @staticmethod
-    def cleanup_sandbox(path: str) -> None:
-        """Remove sandbox directory and all contents."""
-        try:
-            if os.path.exists(path) and path.startswith(tempfile.gettempdir()):
-                shutil.rmtree(path, ignore_errors=True)
-                logger.debug(f"Cleaned up sandbox directory: {path}")
-        except Exception as e:
-            logger.warning(f"Failed to cleanup sandbox {path}: {e}")
+    This checks for:
+    1. OpenAI-format image_url content parts
+    2. File-based image placeholders like [Image #1]
+    
+    Args:
+        messages: List of message dictionaries
+        
+    Returns:
+        True if images are found, False otherwise
+    """
+    if len(messages) > _IMAGE_SCAN_JOIN_THRESHOLD:
+        return _has_image_joined(messages)
+    return any(_iter_image_hits(messages))
+
+
+def create_sandbox() -> str:
+    """Create a temporary sandbox directory for isolated execution."""
+    sandbox_dir = tempfile.mkdtemp(prefix="claude_chat_sandbox_")
+    logger.debug("Created sandbox directory: %s", sandbox_dir)
+    return sandbox_dir
+
+
+def cleanup_sandbox(path: str) -> None:
+    """Remove sandbox directory and all contents."""
+    if not path or not path.startswith(_TEMP_DIR):
+        return
+    try:
+        # rmtree tolerates a missing directory, no need to stat first
+        shutil.rmtree(path, ignore_errors=True)
+        logger.debug("Cleaned up sandbox directory: %s", path)
+    except Exception as e:
+        logger.warning("Failed to cleanup sandbox %s: %s", path, e)
+
+
+class ChatMode:
+    """Core chat mode functionality.
+    
+    Namespace kept for backwards compatibility; the module-level functions
+    are the implementation and can be called directly.
+    """
+    
+    get_allowed_tools = staticmethod(get_allowed_tools)
+    get_allowed_tools_for_request = staticmethod(get_allowed_tools_for_request)
+    _check_messages_for_images = staticmethod(check_messages_for_images)
+    create_sandbox = staticmethod(create_sandbox)
+    cleanup_sandbox = staticmethod(cleanup_sandbox)
+
+
+class LazySandbox:
+    """Sandbox directory that is only created on first access to ``path``.
+    
+    Requests that fail before spawning the CLI never touch the filesystem,
+    and ``cleanup()`` is a no-op when the directory was never created.
+    """
+    
+    def __init__(self):
+        self._path: Optional[str] = None
+    
+    @property
+    def created(self) -> bool:
+        """Whether the sandbox directory has been materialized."""
+        return self._path is not None
+    
+    @property
+    def path(self) -> str:
+        """Sandbox directory path, creating the directory if needed."""
+        if self._path is None:
+            self._path = create_sandbox()
+        return self._path
+    
+    def cleanup(self) -> None:
+        """Remove the sandbox directory if it was created."""
+        if self._path is not None:
+            cleanup_sandbox(self._path)
+            self._path = None
 
 
 @contextmanager
@@ -119,39 +279,95 @@ def sanitized_environment():
     
     Removes path-revealing variables during execution and restores them after.
     """
-    original_env = {}
+    env = os.environ
     
-    # Variables that might reveal system paths
-    sensitive_vars = ['PWD', 'OLDPWD', 'HOME', 'USER', 'LOGNAME']
+    # Sensitive variables that are actually set (C-level set/dict intersection),
+    # plus any Claude-specific path variables
+    to_remove = set(_SENSITIVE_ENV_SET.intersection(env))
+    to_remove.update(k for k in env if k.startswith(_CLAUDE_ENV_PREFIX) and 'DIR' in k)
     
-    # Claude-specific variables that might contain paths
-    claude_vars = [k for k in os.environ.keys() if k.startswith('CLAUDE_') and 'DIR' in k]
+    # Store and remove them
+    original_env = {var: env.pop(var) for var in to_remove}
     
-    # Store and remove sensitive variables
-    for var in sensitive_vars + claude_vars:
-        if var in os.environ:
-            original_env[var] = os.environ.pop(var)
-            logger.debug(f"Temporarily removed environment variable: {var}")
+    if original_env:
+        logger.debug("Temporarily removed environment variables: %s", list(original_env))
     
     try:
         yield
     finally:
         # Restore original environment
-        for var, value in original_env.items():
-            os.environ[var] = value
-            logger.debug(f"Restored environment variable: {var}")
+        env.update(original_env)
 
 
-def get_chat_mode_info() -> Dict[str, Any]:
-    """Get current chat mode configuration and status.
+def sanitized_env_dict(keep: Iterable[str] = ()) -> Dict[str, str]:
+    """
+    Build a copy of the environment without sensitive variables.
+    
+    Intended as the ``env=`` argument for subprocesses, so the sandboxed
+    CLI never sees path-revealing variables and ``os.environ`` itself is
+    never mutated (which is not safe with concurrent requests).
     
+    Args:
+        keep: Sensitive variable names to preserve anyway (e.g. HOME)
+        
     Returns:
-        Dict containing chat mode configuration
+        Dict of environment variables safe to pass to a sandboxed process
     """
+    removed = _SENSITIVE_ENV_SET.difference(keep)
     return {
-        "enabled": True,
-        "allowed_tools": ChatMode.get_allowed_tools(),
-        "sandbox_enabled": True,
-        "sessions_disabled": True,
-        "file_operations_disabled": True
-    }
\ No newline at end of file
+        k: v for k, v in os.environ.items()
+        if k not in removed and not (k.startswith(_CLAUDE_ENV_PREFIX) and 'DIR' in k)
+    }
+
+
+def filter_sensitive_paths(text: str, source: str = "CLI") -> str:
+    """
+    Replace sandbox and temp directory paths in CLI output with generic text.
+    
+    Args:
+        text: Output text from a sandboxed CLI
+        source: Name of the CLI, used in the debug log
+        
+    Returns:
+        Text with path information removed
+    """
+    # Nearly all output mentions no path at all; every pattern below needs one
+    # of these substrings (the sandbox name case-insensitively). Underscores
+    # have no case, so text without one never needs the lowercased copy.
+    if ('/tmp/' not in text and '/var/folders/' not in text
+            and ('_' not in text or 'claude_chat_sandbox' not in text.lower())):
+        return text
+    
+    # subn() reports whether anything matched, so no separate search() pass
+    text, path_count = _SANDBOX_PATH_RE.subn(_SANDBOX_PATH_REPLACEMENT, text)
+    text, token_count = _SANDBOX_TOKEN_RE.subn(_SANDBOX_PATH_REPLACEMENT, text)
+    path_found = bool(path_count or token_count)
+    
+    # If we found and replaced paths, also replace common directory listing phrases
+    if path_found:
+        text = _DIRECTORY_PHRASE_RE.sub(_DIRECTORY_PHRASE_REPLACEMENT, text)
+    
+    # The sandbox pass usually rewrites the only /tmp/ reference, so check
+    # again before running the temp-path pattern over the text
+    if '/tmp/' in text or '/var/folders/' in text:
+        text = _TEMP_PATH_RE.sub(_TEMP_PATH_REPLACEMENT, text)
+    
+    if path_found:
+        logger.debug("Filtered sensitive path information from %s response", source)
+    
+    return text
+
+
+def get_chat_mode_info(is_chat_mode: bool = True) -> Mapping[str, Any]:
+    """Get current chat mode configuration and status.
+    
+    The result is a shared read-only mapping; use ``dict(...)`` on it if a
+    mutable copy is needed.
+    
+    Args:
+        is_chat_mode: Whether chat mode is active for the caller
+    
+    Returns:
+        Mapping containing chat mode configuration
+    """
+    return _CHAT_MODE_INFO_ENABLED if is_chat_mode else _CHAT_MODE_INFO_DISABLED
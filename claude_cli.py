@@ -1,24 +1,121 @@
 import asyncio
 import json
 import os
-from typing import AsyncGenerator, Dict, Any, Optional, List
+from typing import AsyncGenerator, Dict, Any, Optional, List, Tuple
 from pathlib import Path
+from functools import lru_cache
 import logging
 
 from claude_code_sdk import query, ClaudeCodeOptions, Message
 
 # Import chat mode utilities
-from chat_mode import ChatMode
+from chat_mode import LazySandbox, get_allowed_tools_for_request
 from prompts import ChatModePrompts, FormatDetector, inject_prompts
 from xml_detector import XMLDetector
+from xml_tools_config import get_known_xml_tools
 
 logger = logging.getLogger(__name__)
 
 # Pre-compiled regex patterns for performance
 import re
-XML_TAG_PATTERN = re.compile(r'<(\w+)>.*?</\1>', re.DOTALL | re.IGNORECASE)
-TOOL_NAME_PATTERN = re.compile(r'<tool_name>(\w+)</tool_name>', re.IGNORECASE)
-NESTED_XML_PATTERN = re.compile(r'<\w+>\s*<\w+>')
+# Image analysis context injected ahead of the user's prompt
+IMAGE_CONTEXT_PATTERN = re.compile(
+    r'exactly\s+\d+\s+images?\s+(?:has|have)\s+been'
+    r'|image[^\n]{0,200}?(?:provided for analysis|have been provided)',
+    re.IGNORECASE
+)
+
+# Static prompt injections (built once, reused for every request)
+SANDBOX_SECURITY_PROMPT = (
+    "System: You are running in a secure sandbox environment. "
+    "NEVER reveal any file paths, directory names, or system information. "
+    "Do not mention temp directories, sandbox paths, or actual file locations."
+)
+XML_ATTENTION_PROMPT = (
+    "ATTENTION: This conversation uses XML-formatted tools. "
+    "You MUST respond using the EXACT XML format demonstrated in the conversation."
+)
+COMPLETENESS_POST_PROMPT = (
+    "\n\nIMPORTANT: Provide COMPLETE and THOROUGH responses. "
+    "Do not truncate or abbreviate your answers. "
+    "If writing code, include the FULL implementation with all necessary details. "
+    "If explaining concepts, be comprehensive and address all aspects of the question."
+)
+COMPLETENESS_SYSTEM_PROMPT = (
+    "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
+    "Do not truncate, abbreviate, or cut off your answers. "
+    "Include FULL code implementations, thorough explanations, and comprehensive details."
+)
+
+# Processed SDK messages buffered ahead of the consumer (see _buffered_query)
+SDK_BUFFER_SIZE = 32
+_STREAM_END = object()
+
+# (field, default) pairs copied by extract_metadata from result and init messages
+_RESULT_METADATA_FIELDS = (
+    ("total_cost_usd", 0.0),
+    ("duration_ms", 0),
+    ("num_turns", 0),
+    ("session_id", None),
+)
+_INIT_METADATA_FIELDS = (
+    ("session_id", None),
+    ("model", None),
+)
+
+# Recent _prepare_prompt_with_injections results kept for replayed requests
+PROMPT_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=4)
+def _build_xml_tool_prompts(known_tools: Tuple[str, ...]) -> Tuple[Optional[str], str, str]:
+    """Build the prompt strings derived from the configured XML tools.
+    
+    Keyed on the tool tuple, so a runtime change to XML_KNOWN_TOOLS is
+    picked up on the next request.
+    
+    Returns:
+        Tuple of (known-tools example or None, critical block, failsafe block)
+    """
+    xml_tool_tags = ', '.join(f'<{tool}>' for tool in known_tools)
+    
+    # Example text used when the standard Roo/Cline completion tools are configured
+    if 'attempt_completion' in known_tools:
+        example_text = (
+            "\n\nREMINDER: Format your response using XML tags.\n"
+            "For completing tasks, format as: <attempt_completion>\n<result>your response</result>\n</attempt_completion>\n"
+        )
+        if 'ask_followup_question' in known_tools:
+            example_text += "For asking questions, format as: <ask_followup_question>\n<question>your question here</question>\n</ask_followup_question>\n"
+        example_text += "DO NOT use <environment_details>, <task>, or other structural tags - only the response formatting tags above."
+    else:
+        example_text = None
+    
+    tool_list_str = (
+        f"2. Use ONLY these XML formatting tags: {xml_tool_tags}\n"
+        if known_tools else "2. Format your response with appropriate XML tags\n"
+    )
+    critical_block = (
+        "\n\nCRITICAL - THIS IS MANDATORY:\n"
+        "1. Your ENTIRE response MUST be formatted using XML tags\n"
+        + tool_list_str +
+        "3. DO NOT use <environment_details>, <task>, <response> or any non-formatting tags\n"
+        "4. Start your response with an opening XML tag and end with the closing tag\n"
+        "5. NO plain text outside the XML tags\n"
+        "6. For general responses, use the appropriate XML formatting tags\n\n"
+        "CLARIFICATION: These XML tags are RESPONSE FORMATTING - NOT Claude tools.\n"
+        "You don't need any SDK tools to use these XML tags. Simply format your text response within them.\n\n"
+        "IMPORTANT: Provide COMPLETE responses - do not truncate or abbreviate."
+    )
+    failsafe_block = (
+        "\n\n[FAILSAFE XML ENFORCEMENT]\n"
+        "CRITICAL: You MUST format your response using XML tags.\n"
+        "Wrap your ENTIRE response in formatting tags.\n"
+        + (f"Use one of: {xml_tool_tags}\n" if known_tools else "") +
+        "DO NOT respond with plain text or markdown!\n"
+        "Remember: These are response formatting tags, NOT SDK tools."
+    )
+    return example_text, critical_block, failsafe_block
 
 
 class ClaudeCodeCLI:
@@ -31,6 +128,11 @@ class ClaudeCodeCLI:
         self.xml_detector = XMLDetector()
         self.last_session_id = None  # Track session ID for cleanup
         
+        # Pre-build the role-prefixed static prompts and the XML tool prompts
+        self._reinforcement_system_prompt = f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}"
+        self._no_files_system_prompt = f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}"
+        self._prompt_cache: Dict[tuple, Tuple[str, bool]] = {}  # insertion-ordered LRU
+        
         # Import auth manager
         from auth import auth_manager, validate_claude_code_auth
         
@@ -44,27 +146,34 @@ class ClaudeCodeCLI:
         # Store auth environment variables for SDK
         self.claude_env_vars = auth_manager.get_claude_code_env_vars()
         
+        # The SDK subprocess inherits os.environ. These values are process-wide,
+        # so export them once here rather than swapping them around every
+        # request (which races between concurrent completions)
+        if self.claude_env_vars:
+            os.environ.update(self.claude_env_vars)
+        
     async def verify_cli(self) -> bool:
         """Verify Claude Code SDK is working and authenticated."""
         try:
             # Test SDK with a simple query
             logger.info("Testing Claude Code SDK...")
             
-            messages = []
+            # Only whether anything came back matters; don't keep the messages
+            received = False
             async for message in query(
                 prompt="Hello",
                 options=ClaudeCodeOptions(
                     max_turns=1
                 )
             ):
-                messages.append(message)
+                received = True
                 # Break early on first response to speed up verification
                 # Handle both dict and object types
-                msg_type = getattr(message, 'type', None) if hasattr(message, 'type') else message.get("type") if isinstance(message, dict) else None
+                msg_type = getattr(message, 'type', None) or (message.get("type") if isinstance(message, dict) else None)
                 if msg_type == "assistant":
                     break
             
-            if messages:
+            if received:
                 logger.info("✅ Claude Code SDK verified successfully")
                 return True
             else:
@@ -80,16 +189,59 @@ class ClaudeCodeCLI:
             return False
     
     
-    def _prepare_prompt_with_injections(self, prompt: str, messages: Optional[List[Dict]] = None, requires_xml: bool = False) -> str:
-        """Prepare prompt with system injections based on format detection."""
-        logger.debug(f"Preparing prompt with injections, requires_xml={requires_xml}")
+    @staticmethod
+    def _prompt_cache_key(prompt: str, messages: Optional[List[Dict]], requires_xml: bool) -> Optional[tuple]:
+        """Build a key covering every input the prepared prompt depends on.
+        
+        Returns None for multimodal (list) content: keying on it would
+        copy base64 image data on every call and keep it alive in the cache.
+        """
+        contents = []
+        for m in messages or ():
+            c = m.get("content")
+            if c is not None and not isinstance(c, str):
+                return None
+            contents.append((m.get("role"), c))
+        return (
+            requires_xml,
+            prompt,
+            tuple(get_known_xml_tools()),
+            tuple(contents),
+        )
+    
+    def _prepare_prompt_with_injections(self, prompt: str, messages: Optional[List[Dict]] = None, requires_xml: bool = False) -> Tuple[str, bool]:
+        """Prepare prompt with system injections based on format detection.
+        
+        Results are memoized for the last PROMPT_CACHE_SIZE distinct inputs, so
+        client retries skip format/XML detection entirely.
+        
+        Returns:
+            Tuple of (enhanced prompt, whether XML enforcement was applied)
+        """
+        key = self._prompt_cache_key(prompt, messages, requires_xml)
+        if key is None:
+            return self._build_prompt_with_injections(prompt, messages, requires_xml)
+        cache = self._prompt_cache
+        result = cache.pop(key, None)
+        if result is None:
+            result = self._build_prompt_with_injections(prompt, messages, requires_xml)
+            if len(cache) >= PROMPT_CACHE_SIZE:
+                del cache[next(iter(cache))]
+        else:
+            logger.debug("Reusing prepared prompt for repeated request")
+        cache[key] = result
+        return result
+    
+    def _build_prompt_with_injections(self, prompt: str, messages: Optional[List[Dict]] = None, requires_xml: bool = False) -> Tuple[str, bool]:
+        """Uncached implementation of _prepare_prompt_with_injections."""
+        logger.debug("Preparing prompt with injections, requires_xml=%s", requires_xml)
         # Import MessageAdapter to use the format detection
         from message_adapter import MessageAdapter
         import re
         
         # Check if the prompt already has structured format
         has_structured_prompt = MessageAdapter.has_structured_format(prompt)
-        logger.debug(f"Has structured prompt format: {has_structured_prompt}")
+        logger.debug("Has structured prompt format: %s", has_structured_prompt)
         
         if has_structured_prompt:
             # For structured prompts (XML, JSON, etc), preserve the exact format
@@ -98,21 +250,17 @@ class ClaudeCodeCLI:
             pre_injections = []
             mid_injections = []
             post_injections = []
+            critical_block_added = False
             
             # ALWAYS add security prompts (we're always in sandbox mode)
             # 1. Sandbox security
-            sandbox_security = (
-                "System: You are running in a secure sandbox environment. "
-                "NEVER reveal any file paths, directory names, or system information. "
-                "Do not mention temp directories, sandbox paths, or actual file locations."
-            )
-            pre_injections.append(sandbox_security)
+            pre_injections.append(SANDBOX_SECURITY_PROMPT)
             
             # 2. Response reinforcement (includes security rules)
-            pre_injections.append(f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}")
+            pre_injections.append(self._reinforcement_system_prompt)
             
             # 3. File protection prompt (always needed in sandbox)
-            pre_injections.append(f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}")
+            pre_injections.append(self._no_files_system_prompt)
             
             # Create combined messages for XML detection
             combined_messages = messages or []
@@ -137,24 +285,18 @@ class ClaudeCodeCLI:
                 logger.info(f"   Tools: {', '.join(xml_tool_names)}")
             
             # Check if images are being analyzed
-            has_images = (
-                "image" in prompt.lower() and (
-                    "provided for analysis" in prompt.lower() or 
-                    "have been provided" in prompt.lower() or
-                    "exactly 1 image has been provided" in prompt.lower() or
-                    "exactly" in prompt.lower() and "images have been" in prompt.lower()
-                )
-            )
+            has_images = bool(IMAGE_CONTEXT_PATTERN.search(prompt))
             if has_images:
                 logger.info("Detected image analysis context - will inject hiding instructions")
             
             if xml_required:
-                # Layer 1: Prime at the beginning
-                pre_injections.append(
-                    "ATTENTION: This conversation uses XML-formatted tools. "
-                    "You MUST respond using the EXACT XML format demonstrated in the conversation."
+                known_tools_example, critical_block, failsafe_block = _build_xml_tool_prompts(
+                    tuple(get_known_xml_tools())
                 )
                 
+                # Layer 1: Prime at the beginning
+                pre_injections.append(XML_ATTENTION_PROMPT)
+                
                 # Also add image hiding if images are present
                 if has_images:
                     pre_injections.append(self.prompts.IMAGE_ANALYSIS_HIDING_PROMPT)
@@ -166,17 +308,8 @@ class ClaudeCodeCLI:
                     primary_tool = xml_tool_names[0]
                     
                     # Build more specific guidance based on configured tools
-                    from xml_tools_config import get_known_xml_tools
-                    known_tools = get_known_xml_tools()
-                    
-                    if 'attempt_completion' in known_tools:
-                        example_text = (
-                            f"\n\nREMINDER: Format your response using XML tags.\n"
-                            f"For completing tasks, format as: <attempt_completion>\n<result>your response</result>\n</attempt_completion>\n"
-                        )
-                        if 'ask_followup_question' in known_tools:
-                            example_text += f"For asking questions, format as: <ask_followup_question>\n<question>your question here</question>\n</ask_followup_question>\n"
-                        example_text += f"DO NOT use <environment_details>, <task>, or other structural tags - only the response formatting tags above."
+                    if known_tools_example:
+                        example_text = known_tools_example
                     else:
                         example_text = (
                             f"\n\nREMINDER: Your response MUST be formatted with XML tags.\n"
@@ -186,28 +319,13 @@ class ClaudeCodeCLI:
                         )
                     
                     mid_injections.append(example_text)
-                    logger.debug(f"Added specific XML formatting guidance for: {xml_tool_names}")
+                    logger.debug("Added specific XML formatting guidance for: %s", xml_tool_names)
                 
                 # Layer 3: Critical final enforcement
-                from xml_tools_config import get_known_xml_tools
-                known_tools_list = get_known_xml_tools()
-                tool_list_str = f"2. Use ONLY these XML formatting tags: {', '.join([f'<{tool}>' for tool in known_tools_list])}\n" if known_tools_list else "2. Format your response with appropriate XML tags\n"
-                
-                tool_instruction = (
-                    "\n\nCRITICAL - THIS IS MANDATORY:\n"
-                    "1. Your ENTIRE response MUST be formatted using XML tags\n"
-                    + tool_list_str +
-                    "3. DO NOT use <environment_details>, <task>, <response> or any non-formatting tags\n"
-                    "4. Start your response with an opening XML tag and end with the closing tag\n"
-                    "5. NO plain text outside the XML tags\n"
-                    "6. For general responses, use the appropriate XML formatting tags\n\n"
-                    "CLARIFICATION: These XML tags are RESPONSE FORMATTING - NOT Claude tools.\n"
-                    "You don't need any SDK tools to use these XML tags. Simply format your text response within them.\n\n"
-                    "IMPORTANT: Provide COMPLETE responses - do not truncate or abbreviate."
-                )
-                post_injections.append(tool_instruction)
+                post_injections.append(critical_block)
+                critical_block_added = True
                 logger.info("XML ENFORCEMENT ACTIVE: Multi-layer XML response formatting enforcement applied")
-                logger.debug(f"Enforcement layers: pre={len(pre_injections)}, mid={len(mid_injections)}, post={len(post_injections)}")
+                logger.debug("Enforcement layers: pre=%d, mid=%d, post=%d", len(pre_injections), len(mid_injections), len(post_injections))
             elif not xml_required:
                 # Add image hiding prompt if images are being analyzed (file prompt already added above)
                 if has_images:
@@ -215,66 +333,37 @@ class ClaudeCodeCLI:
                     logger.info("Added image analysis hiding instructions")
                 
                 # Add completeness instruction for non-tool responses
-                post_injections.append(
-                    "\n\nIMPORTANT: Provide COMPLETE and THOROUGH responses. "
-                    "Do not truncate or abbreviate your answers. "
-                    "If writing code, include the FULL implementation with all necessary details. "
-                    "If explaining concepts, be comprehensive and address all aspects of the question."
-                )
+                post_injections.append(COMPLETENESS_POST_PROMPT)
                 logger.debug("Added full prompt with completeness instruction (no XML format required)")
             
-            # Build the final prompt with all injection layers
-            final_prompt = prompt
-            
-            # Apply pre-injections
-            if pre_injections:
-                final_prompt = "\n\n".join(pre_injections) + "\n\n" + final_prompt
-            
-            # Apply mid-injections (after the main content but before final instructions)
-            if mid_injections:
-                final_prompt = final_prompt + "\n\n" + "\n\n".join(mid_injections)
-            
-            # Apply post-injections - CRITICAL: These must be at the END
-            if post_injections:
-                final_prompt = final_prompt + "\n\n" + "\n\n".join(post_injections)
+            # Build the final prompt with all injection layers in a single join:
+            # pre-injections, the prompt, mid-injections (after the main content
+            # but before final instructions), then post-injections - CRITICAL:
+            # these must be at the END
+            parts = pre_injections
+            parts.append(prompt)
+            parts.extend(mid_injections)
+            parts.extend(post_injections)
+            final_prompt = "\n\n".join(parts)
             
             # VERIFICATION: If we detected XML tools but no enforcement was added, add it now
-            if xml_required:
-                # Check if XML enforcement is present in the final prompt
-                enforcement_present = any([
-                    "CRITICAL - THIS IS MANDATORY" in final_prompt,
-                    "Your ENTIRE response MUST be wrapped in proper TOOL XML tags" in final_prompt,
-                    "XML ENFORCEMENT ACTIVE" in logger.handlers[0].baseFilename if logger.handlers else False
-                ])
-                
-                if not enforcement_present:
-                    logger.warning("XML enforcement missing despite detection - adding failsafe enforcement")
-                    failsafe_enforcement = (
-                        "\n\n[FAILSAFE XML ENFORCEMENT]\n"
-                        "CRITICAL: You MUST format your response using XML tags.\n"
-                        "Wrap your ENTIRE response in formatting tags.\n"
-                        f"Use one of: {', '.join([f'<{tool}>' for tool in get_known_xml_tools()])}\n" if get_known_xml_tools() else ""
-                        "DO NOT respond with plain text or markdown!\n"
-                        "Remember: These are response formatting tags, NOT SDK tools."
-                    )
-                    final_prompt = final_prompt + failsafe_enforcement
-                    logger.info("FAILSAFE: Added XML enforcement as final prompt instruction")
-                
-            return final_prompt
+            # (tracked with a flag rather than re-scanning the final prompt)
+            if xml_required and not critical_block_added:
+                logger.warning("XML enforcement missing despite detection - adding failsafe enforcement")
+                final_prompt = final_prompt + failsafe_block
+                logger.info("FAILSAFE: Added XML enforcement as final prompt instruction")
+            
+            return final_prompt, xml_required
         else:
             # For plain text prompts, use the full injection with role prefixes
             prompt_parts = []
             final_parts = []
             
             # Add response reinforcement
-            prompt_parts.append(f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}")
-            prompt_parts.append(f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}")
+            prompt_parts.append(self._reinforcement_system_prompt)
+            prompt_parts.append(self._no_files_system_prompt)
             # Add completeness instruction
-            prompt_parts.append(
-                "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
-                "Do not truncate, abbreviate, or cut off your answers. "
-                "Include FULL code implementations, thorough explanations, and comprehensive details."
-            )
+            prompt_parts.append(COMPLETENESS_SYSTEM_PROMPT)
             
             # Add user prompt
             prompt_parts.append(f"User: {prompt}")
@@ -289,11 +378,48 @@ class ClaudeCodeCLI:
                     final_parts.append(f"System: {final_reinforcement}")
             
             # Combine all parts with final reinforcement at the very end
-            full_prompt = "\n\n".join(prompt_parts)
-            if final_parts:
-                full_prompt += "\n\n" + "\n\n".join(final_parts)
-                
-            return full_prompt
+            prompt_parts.extend(final_parts)
+            return "\n\n".join(prompt_parts), False
+    
+    async def _drain_query(self, prompt: str, options: ClaudeCodeOptions, queue: asyncio.Queue) -> None:
+        """Producer: pull messages from the SDK, process them and queue them.
+        
+        Errors are queued rather than raised so the consumer re-raises them
+        in its own context.
+        """
+        # Bound once; both are called for every streamed message
+        process = self._process_message
+        put = queue.put
+        try:
+            async for message in query(prompt=prompt, options=options):
+                await put(process(message))
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_STREAM_END)
+    
+    async def _buffered_query(self, prompt: str, options: ClaudeCodeOptions) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yield processed SDK messages through a bounded queue.
+        
+        The SDK is drained by a separate task, so it keeps producing while a
+        slow client is still being written to (up to SDK_BUFFER_SIZE messages).
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SDK_BUFFER_SIZE)
+        producer = asyncio.create_task(self._drain_query(prompt, options, queue))
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Consumer stopped early (client went away, error, cancellation)
+            if not producer.done():
+                producer.cancel()
+            # Let the SDK stream unwind before the caller tears down the sandbox
+            await asyncio.gather(producer, return_exceptions=True)
     
     async def run_completion(
         self, 
@@ -315,67 +441,53 @@ class ClaudeCodeCLI:
         if session_id or continue_session:
             logger.warning("Session parameters ignored - each request is stateless")
         
-        # Create sandbox directory for this request
-        sandbox_dir = ChatMode.create_sandbox()
-        cwd = Path(sandbox_dir)
+        # Sandbox directory for this request, created when the SDK options are built
+        sandbox = LazySandbox()
         
         # Note: Image processing is now handled by ImageAnalysisOrchestrator
         # Images are analyzed in a separate CLI call with tools enabled
         # The analysis is then injected as context into the messages
             
         # Set allowed tools based on image presence
-        allowed_tools = ChatMode.get_allowed_tools_for_request(messages or [])
+        allowed_tools = get_allowed_tools_for_request(messages or [])
         
         # Prepare prompt with injections
-        logger.debug(f"Original prompt length: {len(prompt)}")
-        enhanced_prompt = self._prepare_prompt_with_injections(prompt, messages, requires_xml)
-        logger.debug(f"Enhanced prompt length: {len(enhanced_prompt)}")
+        logger.debug("Original prompt length: %d", len(prompt))
+        enhanced_prompt, xml_enforced = self._prepare_prompt_with_injections(prompt, messages, requires_xml)
+        logger.debug("Enhanced prompt length: %d", len(enhanced_prompt))
         if enhanced_prompt != prompt:
-            logger.info(f"Prompt was enhanced with injections (added {len(enhanced_prompt) - len(prompt)} chars)")
-            # Log first and last 500 chars of enhanced prompt
-            if len(enhanced_prompt) > 1000:
-                logger.debug(f"Enhanced prompt start: {enhanced_prompt[:500]}...")
-                logger.info(f"Enhanced prompt end: ...{enhanced_prompt[-500:]}")
-            else:
-                logger.debug(f"Enhanced prompt: {enhanced_prompt}")
+            logger.info("Prompt was enhanced with injections (added %d chars)", len(enhanced_prompt) - len(prompt))
+            # Log first and last 500 chars of enhanced prompt (debug only, avoids slicing otherwise)
+            if logger.isEnabledFor(logging.DEBUG):
+                if len(enhanced_prompt) > 1000:
+                    logger.debug("Enhanced prompt start: %.500s...", enhanced_prompt)
+                    logger.debug("Enhanced prompt end: ...%s", enhanced_prompt[-500:])
+                else:
+                    logger.debug("Enhanced prompt: %s", enhanced_prompt)
             
             # Log the complete SDK options
             logger.info("=== SDK OPTIONS ===")
-            logger.info(f"allowed_tools: {allowed_tools}")
-            logger.info(f"disallowed_tools: {disallowed_tools}")
-            logger.info(f"max_turns: {max_turns}")
-            logger.info(f"model: {model}")
-            logger.info(f"stream: {stream}")
-            logger.info(f"session_id: {session_id}")
-            logger.info(f"continue_session: {continue_session}")
+            logger.info("allowed_tools: %s", allowed_tools)
+            logger.info("disallowed_tools: %s", disallowed_tools)
+            logger.info("max_turns: %s", max_turns)
+            logger.info("model: %s", model)
+            logger.info("stream: %s", stream)
+            logger.info("session_id: %s", session_id)
+            logger.info("continue_session: %s", continue_session)
             logger.info("=== END SDK OPTIONS ===")
             
-        # Verify XML enforcement is present if expected
-        combined_messages = messages or []
-        if prompt:
-            combined_messages = combined_messages + [{"role": "user", "content": prompt}]
-        xml_check_required, _, _ = self.xml_detector.detect(combined_messages)
-        if xml_check_required:
-            if "CRITICAL - THIS IS MANDATORY" in enhanced_prompt or "FAILSAFE XML ENFORCEMENT" in enhanced_prompt:
-                logger.info("✓ XML enforcement successfully added to prompt")
-            else:
-                logger.error("✗ XML enforcement NOT found in enhanced prompt despite confidence detection!")
+        # XML detection already ran while preparing the prompt; reuse its result
+        if xml_enforced:
+            logger.info("✓ XML enforcement successfully added to prompt")
         
         try:
-            # Set authentication environment variables (if any)
-            original_env = {}
-            if self.claude_env_vars:  # Only set env vars if we have any
-                for key, value in self.claude_env_vars.items():
-                    original_env[key] = os.environ.get(key)
-                    os.environ[key] = value
-            
             try:
                 # Execute with sandbox isolation
                 # The SDK needs auth env vars, but execution is still sandboxed via cwd
                 # Build SDK options with sandbox
                 options = ClaudeCodeOptions(
                     max_turns=max_turns,
-                    cwd=cwd  # This provides the file system isolation
+                    cwd=Path(sandbox.path)  # This provides the file system isolation
                 )
                     
                 # Set model if specified
@@ -406,45 +518,52 @@ class ClaudeCodeCLI:
                 logger.info(f"Options allowed_tools: {options.allowed_tools}")
                     
                 
+                buffered = self._buffered_query(enhanced_prompt, options)
                 try:
                     total_content_length = 0
                     sdk_message_count = 0
+                    # Content-length accounting is diagnostic only; skip it unless debugging
+                    debug_enabled = logger.isEnabledFor(logging.DEBUG)
                     
-                    
-                    async for message in query(prompt=enhanced_prompt, options=options):
+                    async for processed_msg in buffered:
                         sdk_message_count += 1
-                        processed_msg = self._process_message(message)
                         msg_type = processed_msg.get('type')
                         msg_subtype = processed_msg.get('subtype')
-                        logger.debug(f"SDK message #{sdk_message_count} type: {msg_type}, subtype: {msg_subtype}")
+                        if debug_enabled:
+                            logger.debug("SDK message #%d type: %s, subtype: %s", sdk_message_count, msg_type, msg_subtype)
                         
                         # Additional logging for assistant messages to track sequencing
                         if msg_type == "assistant":
-                            logger.info(f"Assistant message #{sdk_message_count} detected in SDK stream")
+                            logger.info("Assistant message #%d detected in SDK stream", sdk_message_count)
                         # Log assistant responses with content length tracking
-                        if processed_msg.get("type") == "assistant" or "content" in processed_msg:
+                        if debug_enabled and (msg_type == "assistant" or "content" in processed_msg):
                             content = processed_msg.get("content", [])
                             if isinstance(content, list):
                                 for block in content:
                                     if hasattr(block, 'text'):
                                         block_length = len(block.text)
                                         total_content_length += block_length
-                                        logger.debug(f"Assistant text block length: {block_length}, total so far: {total_content_length}")
+                                        logger.debug("Assistant text block length: %d, total so far: %d", block_length, total_content_length)
                                     elif isinstance(block, dict) and block.get("type") == "text":
                                         block_length = len(block.get("text", ""))
                                         total_content_length += block_length
-                                        logger.debug(f"Assistant text block length: {block_length}, total so far: {total_content_length}")
+                                        logger.debug("Assistant text block length: %d, total so far: %d", block_length, total_content_length)
                             elif isinstance(content, str):
                                 content_length = len(content)
                                 total_content_length += content_length
-                                logger.debug(f"Assistant content length: {content_length}, total so far: {total_content_length}")
-                            logger.debug(f"Assistant message type: {processed_msg.get('type')}, has content: {'content' in processed_msg}")
-                        # Log completion summary
-                        if processed_msg.get("subtype") == "success":
-                            logger.info(f"Response completed - Total content length: {total_content_length} characters")
+                                logger.debug("Assistant content length: %d, total so far: %d", content_length, total_content_length)
+                            logger.debug("Assistant message type: %s, has content: %s", processed_msg.get('type'), 'content' in processed_msg)
+                        # Log completion summary from the SDK's result fields
+                        if msg_subtype == "success":
+                            logger.info(
+                                "Response completed - duration: %sms, turns: %s",
+                                processed_msg.get("duration_ms"), processed_msg.get("num_turns")
+                            )
                         yield processed_msg
                     
-                    logger.info(f"SDK stream ended normally after {sdk_message_count} messages, total content: {total_content_length} chars")
+                    logger.info("SDK stream ended normally after %d messages", sdk_message_count)
+                    if debug_enabled:
+                        logger.debug("Total assistant content: %d chars", total_content_length)
                     logger.info("=== SDK EXECUTION COMPLETED ===")
                 except Exception as sdk_error:
                     # Handle SDK errors gracefully
@@ -458,13 +577,10 @@ class ClaudeCodeCLI:
                         raise
                     
             finally:
-                # Restore original environment (if we changed anything)
-                if original_env:
-                    for key, original_value in original_env.items():
-                        if original_value is None:
-                            os.environ.pop(key, None)
-                        else:
-                            os.environ[key] = original_value
+                # Close the SDK stream now rather than at garbage collection,
+                # so an early exit cancels and awaits its producer task
+                if 'buffered' in locals():
+                    await buffered.aclose()
                 
                 # Cleanup image handler if it was created
                 if 'image_handler' in locals() and image_handler:
@@ -493,25 +609,16 @@ class ClaudeCodeCLI:
     def _process_message(self, message: Any) -> Dict[str, Any]:
         """Process message from SDK to consistent dict format."""
         # Debug logging
-        logger.debug(f"Raw SDK message type: {type(message)}")
-        logger.debug(f"Raw SDK message: {message}")
+        logger.debug("Raw SDK message type: %s", type(message))
+        logger.debug("Raw SDK message: %s", message)
         
         # Convert message object to dict if needed
         if hasattr(message, '__dict__') and not isinstance(message, dict):
-            # Convert object to dict for consistent handling
-            message_dict = {}
-            
-            # Get all attributes from the object
-            for attr_name in dir(message):
-                if not attr_name.startswith('_'):  # Skip private attributes
-                    try:
-                        attr_value = getattr(message, attr_name)
-                        if not callable(attr_value):  # Skip methods
-                            message_dict[attr_name] = attr_value
-                    except:
-                        pass
+            # Convert object to dict for consistent handling. SDK messages are
+            # dataclasses, so their fields live in the instance __dict__.
+            message_dict = {k: v for k, v in vars(message).items() if not k.startswith('_')}
             
-            logger.debug(f"Converted message dict: {message_dict}")
+            logger.debug("Converted message dict: %s", message_dict)
             processed_msg = message_dict
         else:
             processed_msg = message
@@ -529,35 +636,40 @@ class ClaudeCodeCLI:
             
         return processed_msg
     
+    @staticmethod
+    def _text_parts(blocks: List[Any]) -> List[str]:
+        """Collect text from content blocks (TextBlock objects, dicts or strings)."""
+        text_parts = []
+        for block in blocks:
+            # Handle TextBlock objects
+            text = getattr(block, 'text', None)
+            if text is not None:
+                text_parts.append(text)
+            elif isinstance(block, dict):
+                if block.get("type") == "text":
+                    text_parts.append(block.get("text", ""))
+            elif isinstance(block, str):
+                text_parts.append(block)
+        return text_parts
+    
     def parse_claude_message(self, messages: List[Dict[str, Any]]) -> Optional[str]:
         """Extract the assistant message from Claude Code SDK messages."""
         for message in messages:
+            content = message.get("content")
             # Look for AssistantMessage type (new SDK format)
-            if "content" in message and isinstance(message["content"], list):
-                text_parts = []
-                for block in message["content"]:
-                    # Handle TextBlock objects
-                    if hasattr(block, 'text'):
-                        text_parts.append(block.text)
-                    elif isinstance(block, dict) and block.get("type") == "text":
-                        text_parts.append(block.get("text", ""))
-                    elif isinstance(block, str):
-                        text_parts.append(block)
-                
+            if isinstance(content, list):
+                text_parts = self._text_parts(content)
                 if text_parts:
                     return "\n".join(text_parts)
             
             # Fallback: look for old format
             elif message.get("type") == "assistant" and "message" in message:
                 sdk_message = message["message"]
-                if isinstance(sdk_message, dict) and "content" in sdk_message:
-                    content = sdk_message["content"]
-                    if isinstance(content, list) and len(content) > 0:
+                if isinstance(sdk_message, dict):
+                    content = sdk_message.get("content")
+                    if isinstance(content, list) and content:
                         # Handle content blocks (Anthropic SDK format)
-                        text_parts = []
-                        for block in content:
-                            if isinstance(block, dict) and block.get("type") == "text":
-                                text_parts.append(block.get("text", ""))
+                        text_parts = self._text_parts(content)
                         return "\n".join(text_parts) if text_parts else None
                     elif isinstance(content, str):
                         return content
@@ -574,36 +686,45 @@ class ClaudeCodeCLI:
             "model": None
         }
         
-        for message in messages:
-            # New SDK format - ResultMessage
-            if message.get("subtype") == "success" and "total_cost_usd" in message:
-                metadata.update({
-                    "total_cost_usd": message.get("total_cost_usd", 0.0),
-                    "duration_ms": message.get("duration_ms", 0),
-                    "num_turns": message.get("num_turns", 0),
-                    "session_id": message.get("session_id")
-                })
-            # New SDK format - SystemMessage  
-            elif message.get("subtype") == "init" and "data" in message:
-                data = message["data"]
-                metadata.update({
-                    "session_id": data.get("session_id"),
-                    "model": data.get("model")
-                })
-            # Old format fallback
-            elif message.get("type") == "result":
-                metadata.update({
-                    "total_cost_usd": message.get("total_cost_usd", 0.0),
-                    "duration_ms": message.get("duration_ms", 0),
-                    "num_turns": message.get("num_turns", 0),
-                    "session_id": message.get("session_id")
-                })
-            elif message.get("type") == "system" and message.get("subtype") == "init":
-                metadata.update({
-                    "session_id": message.get("session_id"),
-                    "model": message.get("model")
-                })
-                
+        # Later messages win, so scan from the end and stop once both a result
+        # and an init message have been seen; every field is settled by then
+        values = {}
+        seen_result = seen_init = False
+        for message in reversed(messages):
+            get = message.get
+            subtype = get("subtype")
+            # New SDK format - ResultMessage / SystemMessage
+            if subtype == "success" and "total_cost_usd" in message:
+                source, fields = message, _RESULT_METADATA_FIELDS
+            elif subtype == "init" and "data" in message:
+                source, fields = message["data"], _INIT_METADATA_FIELDS
+            else:
+                # Old format fallback
+                msg_type = get("type")
+                if msg_type == "result":
+                    source, fields = message, _RESULT_METADATA_FIELDS
+                elif msg_type == "system" and subtype == "init":
+                    source, fields = message, _INIT_METADATA_FIELDS
+                else:
+                    continue
+            
+            if fields is _RESULT_METADATA_FIELDS:
+                if seen_result:
+                    continue
+                seen_result = True
+            else:
+                if seen_init:
+                    continue
+                seen_init = True
+            
+            for field, default in fields:
+                if field not in values:
+                    values[field] = source.get(field, default)
+            
+            if seen_result and seen_init:
+                break
+        
+        metadata.update(values)
         return metadata
     
     def get_last_session_id(self) -> Optional[str]:
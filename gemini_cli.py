@@ -1,20 +1,102 @@
 import asyncio
-import json
+import codecs
 import os
-import subprocess
-from typing import AsyncGenerator, Dict, Any, Optional, List
-from pathlib import Path
+import shutil
+from functools import lru_cache
+from typing import AsyncGenerator, Dict, Any, Optional, List, Tuple
 import logging
-import shlex
 import re
 
 # Import chat mode utilities
-from chat_mode import ChatMode, sanitized_environment
+from chat_mode import LazySandbox, filter_sensitive_paths, sanitized_env_dict
 from prompts import ChatModePrompts, FormatDetector
 from xml_detector import XMLDetector
+from xml_tools_config import get_known_xml_tools
 
 logger = logging.getLogger(__name__)
 
+# Static security prompts (role-prefixed, reused for every request)
+IMAGE_CONTEXT_SECURITY_PROMPT = (
+    "System: You are responding based on analyzed image content. "
+    "You may discuss the image analysis results naturally. "
+    "Do not reveal system paths or directory structures."
+)
+GEMINI_PATH_PROTECTION_PROMPT = (
+    "System: CRITICAL PATH SECURITY: You are running in a secure sandbox environment. "
+    "NEVER reveal any file paths, directory names, or system information. "
+    "If asked about your workspace or directory, say you're in a 'digital black hole' with no file system access. "
+    "Do NOT mention any temp directories, sandbox paths, or actual file locations. "
+    "Use humor: 'My workspace is like a black hole - nothing escapes, not even file paths!'"
+)
+COMPLETENESS_SYSTEM_PROMPT = (
+    "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
+    "Do not truncate, abbreviate, or cut off your answers. "
+    "Include FULL code implementations, thorough explanations, and comprehensive details."
+)
+
+# Models typically available via Gemini CLI
+GEMINI_MODELS = (
+    'gemini-2.5-pro',
+    'gemini-2.5-flash',
+    'gemini-1.5-pro',
+    'gemini-1.5-flash',
+    'gemini-1.0-pro',
+    'gemini-2.0-flash-exp',
+)
+
+# Max bytes per stdout read; read() returns whatever is already available, so
+# a large size only cuts the number of reads when output arrives in bursts
+STREAM_READ_SIZE = 65536
+
+# Number of distinct conversations whose prepared prompt is kept
+PROMPT_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=4)
+def _build_xml_final_instruction(known_tools: Tuple[str, ...]) -> str:
+    """Build the XML enforcement instruction for the configured XML tools."""
+    xml_enforcement = [
+        "\n\n🚨 MANDATORY RESPONSE FORMAT 🚨\n"
+        "You MUST wrap your ENTIRE response in XML tags. These are FORMATTING instructions, not tools.\n\n"
+    ]
+    
+    # Add examples based on configured tools
+    if 'attempt_completion' in known_tools:
+        xml_enforcement.append(
+            "EXAMPLE of correct response format:\n"
+            "<attempt_completion>\n"
+            "<result>\n"
+            "Your actual answer goes here. For example: Red is a primary color.\n"
+            "</result>\n"
+            "</attempt_completion>\n\n"
+        )
+    
+    if 'ask_followup_question' in known_tools:
+        xml_enforcement.append(
+            "OR if you need more information:\n"
+            "<ask_followup_question>\n"
+            "<question>What specific aspect would you like to know?</question>\n"
+            "</ask_followup_question>\n\n"
+        )
+    
+    xml_enforcement.append(
+        "IMPORTANT:\n"
+        "- These are NOT tools you 'have access to' - they are XML formatting tags\n"
+        "- Think of them like HTML tags - you wrap your content in them\n"
+    )
+    
+    if known_tools:
+        xml_enforcement.append(f"- Start with one of: {', '.join([f'<{tool}>' for tool in known_tools])}\n")
+    else:
+        xml_enforcement.append("- Start with an appropriate XML tag\n")
+    
+    xml_enforcement.append(
+        "- End with the corresponding closing tag\n"
+        "- Put your actual response content between the tags\n"
+        "- NO text outside the XML tags!"
+    )
+    return f"FINAL INSTRUCTION: {''.join(xml_enforcement)}"
+
 
 class GeminiCLI:
     """Gemini CLI integration for OpenAI-compatible API wrapper."""
@@ -33,6 +115,22 @@ class GeminiCLI:
         self.format_detector = FormatDetector()
         self.prompts = ChatModePrompts()
         self.xml_detector = XMLDetector()
+        self._verified = False  # Set once verify_cli() succeeds
+        self._prompt_cache: Dict[tuple, str] = {}  # insertion-ordered LRU
+        
+        # Security preambles never change between requests, so join them once
+        reinforcement = f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}"
+        self._security_preamble = "\n\n".join([
+            reinforcement,
+            f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}",
+            GEMINI_PATH_PROTECTION_PROMPT,
+            COMPLETENESS_SYSTEM_PROMPT,
+        ])
+        self._image_context_preamble = "\n\n".join([
+            reinforcement,
+            IMAGE_CONTEXT_SECURITY_PROMPT,
+            COMPLETENESS_SYSTEM_PROMPT,
+        ])
         
         logger.info(f"Initialized Gemini CLI with model: {self.default_model}")
     
@@ -40,73 +138,7 @@ class GeminiCLI:
         """Filter out sensitive path information from responses in chat mode."""
         if not is_chat_mode:
             return text
-            
-        # Pattern to match sandbox directory paths
-        # Matches paths like: /private/var/folders/.../claude_chat_sandbox_xxx
-        # or /tmp/claude_chat_sandbox_xxx
-        sandbox_patterns = [
-            r'/private/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'/tmp/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'claude_chat_sandbox_[a-zA-Z0-9_]+',
-            # Also match general temp directory patterns when they contain "claude_chat_sandbox"
-            r'[^\s]*claude_chat_sandbox[^\s]*'
-        ]
-        
-        filtered_text = text
-        path_found = False
-        
-        for pattern in sandbox_patterns:
-            if re.search(pattern, filtered_text, re.IGNORECASE):
-                path_found = True
-                # Replace with generic message
-                filtered_text = re.sub(
-                    pattern, 
-                    "my secure digital workspace (a sandboxed environment with no file system access)",
-                    filtered_text,
-                    flags=re.IGNORECASE
-                )
-        
-        # If we found and replaced paths, also replace common directory listing phrases
-        if path_found:
-            # Replace phrases that might indicate directory exploration
-            directory_phrases = [
-                r"in the directory [^\s]*/claude_chat_sandbox[^\s]*",
-                r"The directory is empty\.",
-                r"I will list the files in this directory\.",
-                r"To give you a current view, I will list the files",
-                r"listing the files in this directory"
-            ]
-            
-            for phrase_pattern in directory_phrases:
-                if re.search(phrase_pattern, filtered_text, re.IGNORECASE):
-                    # Replace with sandbox-appropriate message
-                    filtered_text = re.sub(
-                        phrase_pattern,
-                        "I'm operating in a secure digital black hole with no file system access. Think of it as a void where files fear to tread!",
-                        filtered_text,
-                        flags=re.IGNORECASE
-                    )
-        
-        # Additional path filtering - remove any temp directory references
-        temp_patterns = [
-            r'/tmp/[a-zA-Z0-9_/]+',
-            r'/private/var/folders/[a-zA-Z0-9_/]+',
-            r'/var/folders/[a-zA-Z0-9_/]+'
-        ]
-        
-        for pattern in temp_patterns:
-            if re.search(pattern, filtered_text):
-                filtered_text = re.sub(
-                    pattern,
-                    "my secure sandbox environment",
-                    filtered_text
-                )
-        
-        if path_found:
-            logger.debug("Filtered sensitive path information from Gemini response")
-            
-        return filtered_text
+        return filter_sensitive_paths(text, "Gemini")
     
     def _has_image_analysis_context(self, messages: Optional[List[Dict]]) -> bool:
         """Check if messages contain image analysis context.
@@ -130,6 +162,48 @@ class GeminiCLI:
         
         return False
     
+    @staticmethod
+    def _prompt_cache_key(messages: List[Dict[str, Any]], requires_xml: bool) -> Optional[tuple]:
+        """Build a key covering every input the prepared prompt depends on.
+        
+        Returns None for multimodal (list) content: keying on it would
+        copy base64 image data on every call and keep it alive in the cache.
+        """
+        contents = []
+        for m in messages:
+            c = m.get('content')
+            if c is not None and not isinstance(c, str):
+                return None
+            contents.append((m.get('role'), c))
+        return (
+            requires_xml,
+            tuple(get_known_xml_tools()),
+            tuple(contents),
+        )
+    
+    def _build_prompt(self, messages: List[Dict[str, Any]], requires_xml: bool = False) -> str:
+        """Convert messages to the final CLI prompt, including injections.
+        
+        Results are memoized for the last PROMPT_CACHE_SIZE distinct inputs, so
+        replayed chat histories and client retries skip prompt assembly and
+        format/XML detection entirely.
+        """
+        key = self._prompt_cache_key(messages, requires_xml)
+        if key is None:
+            prompt = self._messages_to_prompt(messages)
+            return self._prepare_prompt_with_injections(prompt, messages, requires_xml)
+        cache = self._prompt_cache
+        result = cache.pop(key, None)
+        if result is None:
+            prompt = self._messages_to_prompt(messages)
+            result = self._prepare_prompt_with_injections(prompt, messages, requires_xml)
+            if len(cache) >= PROMPT_CACHE_SIZE:
+                del cache[next(iter(cache))]
+        else:
+            logger.debug("Reusing prepared Gemini prompt for repeated request")
+        cache[key] = result
+        return result
+    
     def _prepare_prompt_with_injections(self, prompt: str, messages: Optional[List[Dict]] = None, requires_xml: bool = False) -> str:
         """Prepare prompt with system injections based on format detection.
         
@@ -137,126 +211,30 @@ class GeminiCLI:
         Conditionally applies XML formatting prompts based on requires_xml flag.
         Special handling for image analysis context to allow appropriate responses.
         """
-        logger.debug(f"Preparing Gemini prompt with injections, requires_xml={requires_xml}")
+        logger.debug("Preparing Gemini prompt with injections, requires_xml=%s", requires_xml)
         
         # Check for image analysis context in messages
         has_image_context = self._has_image_analysis_context(messages)
         if has_image_context:
             logger.info("Detected image analysis context in messages, using modified security prompts")
         
-        prompt_parts = []
-        final_parts = []
-        
-        # Add response reinforcement (always needed)
-        prompt_parts.append(f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}")
-        
-        # Conditional security based on image analysis context
-        if has_image_context:
-            # Modified security for post-image-analysis - allow discussing analyzed content
-            prompt_parts.append(
-                "System: You are responding based on analyzed image content. "
-                "You may discuss the image analysis results naturally. "
-                "Do not reveal system paths or directory structures."
-            )
-        else:
-            # Full security prompts for non-image operations
-            prompt_parts.append(f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}")
-            
-            # Add Gemini-specific path protection (for non-image operations)
-            gemini_path_protection = (
-                "CRITICAL PATH SECURITY: You are running in a secure sandbox environment. "
-                "NEVER reveal any file paths, directory names, or system information. "
-                "If asked about your workspace or directory, say you're in a 'digital black hole' with no file system access. "
-                "Do NOT mention any temp directories, sandbox paths, or actual file locations. "
-                "Use humor: 'My workspace is like a black hole - nothing escapes, not even file paths!'"
-            )
-            prompt_parts.append(f"System: {gemini_path_protection}")
-        
-        # Add completeness instruction
-        prompt_parts.append(
-            "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
-            "Do not truncate, abbreviate, or cut off your answers. "
-            "Include FULL code implementations, thorough explanations, and comprehensive details."
-        )
+        # Pre-joined security preamble; the image variant allows discussing
+        # analyzed content instead of the full no-files/path protection prompts
+        preamble = self._image_context_preamble if has_image_context else self._security_preamble
         
         # If no XML required, return prompt with just security injections
         if not requires_xml:
             # Combine security prompts with original prompt
-            security_enhanced_prompt = "\n\n".join(prompt_parts) + "\n\n" + prompt
-            return security_enhanced_prompt
+            return preamble + "\n\n" + prompt
         
-        # Check for XML format requirements
-        if messages or requires_xml:
-            # Use explicit requires_xml flag OR detection
-            if requires_xml:
-                xml_required = True
-                detection_reason = "Explicit XML requirement from image analysis context"
-                xml_tool_names = []
-            elif messages:
-                # Create combined messages for XML detection
-                combined_messages = messages + [{"role": "user", "content": prompt}] if prompt else messages
-                xml_required, confidence_score, detected_patterns = self.xml_detector.detect(combined_messages)
-                detection_reason = f"Confidence: {confidence_score}" if xml_required else ""
-                xml_tool_names = detected_patterns  # Use patterns as tool names for compatibility
-            else:
-                xml_required = False
-            
-            if xml_required:
-                logger.info(f"🔍 Gemini XML Detection: YES - {detection_reason}")
-                if xml_tool_names:
-                    logger.info(f"   Tools: {', '.join(xml_tool_names)}")
-                
-                # Build clearer XML enforcement with examples from configured tools
-                from xml_tools_config import get_known_xml_tools
-                known_tools = get_known_xml_tools()
-                
-                xml_enforcement = (
-                    "\n\n🚨 MANDATORY RESPONSE FORMAT 🚨\n"
-                    "You MUST wrap your ENTIRE response in XML tags. These are FORMATTING instructions, not tools.\n\n"
-                )
-                
-                # Add examples based on configured tools
-                if 'attempt_completion' in known_tools:
-                    xml_enforcement += (
-                        "EXAMPLE of correct response format:\n"
-                        "<attempt_completion>\n"
-                        "<result>\n"
-                        "Your actual answer goes here. For example: Red is a primary color.\n"
-                        "</result>\n"
-                        "</attempt_completion>\n\n"
-                    )
-                
-                if 'ask_followup_question' in known_tools:
-                    xml_enforcement += (
-                        "OR if you need more information:\n"
-                        "<ask_followup_question>\n"
-                        "<question>What specific aspect would you like to know?</question>\n"
-                        "</ask_followup_question>\n\n"
-                    )
-                
-                xml_enforcement += (
-                    "IMPORTANT:\n"
-                    "- These are NOT tools you 'have access to' - they are XML formatting tags\n"
-                    "- Think of them like HTML tags - you wrap your content in them\n"
-                )
-                
-                if known_tools:
-                    xml_enforcement += f"- Start with one of: {', '.join([f'<{tool}>' for tool in known_tools])}\n"
-                else:
-                    xml_enforcement += "- Start with an appropriate XML tag\n"
-                
-                xml_enforcement += (
-                    "- End with the corresponding closing tag\n"
-                    "- Put your actual response content between the tags\n"
-                    "- NO text outside the XML tags!"
-                )
-                # Make this the LAST thing Gemini sees
-                final_parts.insert(0, f"FINAL INSTRUCTION: {xml_enforcement}")
+        # XML is explicitly required past this point, so the detector never needs to run
+        logger.info("🔍 Gemini XML Detection: YES - Explicit XML requirement from image analysis context")
         
-        # Add user prompt
-        prompt_parts.append(f"User: {prompt}")
+        # Security preamble and user prompt
+        prompt_parts = [preamble, f"User: {prompt}"]
         
         # Detect other special formats
+        final_parts = []
         if messages:
             has_tool_defs, has_json_req = self.format_detector.detect_special_formats(messages)
             
@@ -264,60 +242,49 @@ class GeminiCLI:
             if final_reinforcement:
                 final_parts.append(f"System: {final_reinforcement}")
         
-        # Combine all parts - but for XML, prioritize the enforcement
-        if final_parts and any("MANDATORY RESPONSE FORMAT" in part for part in final_parts):
-            # For XML scenarios, put the enforcement first and last for emphasis
-            xml_parts = [p for p in final_parts if "MANDATORY RESPONSE FORMAT" in p]
-            other_parts = [p for p in final_parts if "MANDATORY RESPONSE FORMAT" not in p]
-            
-            # Structure: XML instruction -> prompt -> other parts -> XML instruction again
-            full_prompt = "\n\n".join(xml_parts)
-            full_prompt += "\n\n" + "\n\n".join(prompt_parts)
-            if other_parts:
-                full_prompt += "\n\n" + "\n\n".join(other_parts)
-            full_prompt += "\n\n" + "\n\n".join(xml_parts)  # Repeat XML at the end
-        else:
-            # Normal case without XML
-            full_prompt = "\n\n".join(prompt_parts)
-            if final_parts:
-                full_prompt += "\n\n" + "\n\n".join(final_parts)
-            
-        logger.debug(f"Enhanced Gemini prompt length: {len(full_prompt)} (original: {len(prompt)})")
+        # Put the XML enforcement first and last for emphasis (the LAST thing Gemini sees)
+        # Structure: XML instruction -> prompt -> other parts -> XML instruction again
+        xml_instruction = _build_xml_final_instruction(tuple(get_known_xml_tools()))
+        full_prompt = "\n\n".join([xml_instruction, *prompt_parts, *final_parts, xml_instruction])
+        
+        logger.debug("Enhanced Gemini prompt length: %d (original: %d)", len(full_prompt), len(prompt))
         return full_prompt
     
-    async def verify_cli(self) -> bool:
-        """Verify Gemini CLI is installed and working."""
+    async def verify_cli(self, refresh: bool = False) -> bool:
+        """Verify Gemini CLI is installed and working.
+        
+        A successful check is remembered for the lifetime of the instance;
+        pass ``refresh=True`` to run the check again. Failures are not cached
+        so a fixed installation is picked up on the next call.
+        """
+        if self._verified and not refresh:
+            return True
         try:
             logger.info("Testing Gemini CLI...")
             
-            # Check if gemini command exists
-            result = await asyncio.create_subprocess_exec(
-                'which', self.gemini_path,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-            
-            if result.returncode != 0:
+            # Check if gemini command exists (resolved in-process, no `which` fork)
+            if shutil.which(self.gemini_path) is None:
                 logger.error(f"Gemini CLI not found at: {self.gemini_path}")
                 return False
             
             # Test with a simple prompt
             cmd = [self.gemini_path, '-p', 'Say "OK" if you are working', '-m', 'gemini-2.5-flash']
             
+            # The reply itself is never used; only stderr is kept for the failure log
             process = await asyncio.create_subprocess_exec(
                 *cmd,
-                stdout=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
                 stderr=asyncio.subprocess.PIPE
             )
             
-            stdout, stderr = await asyncio.wait_for(
+            _, stderr = await asyncio.wait_for(
                 process.communicate(),
                 timeout=10
             )
             
             if process.returncode == 0:
                 logger.info("✅ Gemini CLI verified successfully")
+                self._verified = True
                 return True
             else:
                 logger.warning(f"⚠️ Gemini CLI test failed: {stderr.decode()}")
@@ -343,42 +310,28 @@ class GeminiCLI:
         **kwargs
     ) -> AsyncGenerator[str, None]:
         """Stream a completion from Gemini CLI."""
-        original_env = {}  # Initialize here to ensure it's always defined
+        # Sandbox directory is only created once the CLI is actually spawned
+        sandbox = LazySandbox()
+        stderr_task = None
         try:
             model_name = model or self.default_model
             
-            # Always create sandbox directory for this request
-            sandbox_dir = ChatMode.create_sandbox()
-            cwd = Path(sandbox_dir)
-            logger.info(f"Gemini: Using sandbox at {sandbox_dir}")
-            
-            # Convert messages to a single prompt
-            prompt = self._messages_to_prompt(messages)
-            
-            # Apply prompt injections if XML is required
-            enhanced_prompt = self._prepare_prompt_with_injections(prompt, messages, requires_xml)
+            # Convert messages to a single prompt with injections applied
+            enhanced_prompt = self._build_prompt(messages, requires_xml)
             
-            # Build command (without -p flag, we'll use stdin)
-            cmd = [self.gemini_path]
-            cmd.extend(['-m', model_name])
+            # Build command (without -p flag, we'll use stdin); always use sandbox mode (-s)
+            cmd = [self.gemini_path, '-m', model_name, '-s']
             
-            # Always use sandbox mode
-            cmd.append('-s')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Executing Gemini CLI: %s...", ' '.join(cmd))
+            logger.debug("Prompt length: %d chars", len(enhanced_prompt))
             
-            logger.debug(f"Executing Gemini CLI: {' '.join(cmd)}...")
-            logger.debug(f"Prompt length: {len(enhanced_prompt)} chars")
-            
-            # Sanitize environment for sandbox
+            # Sanitize environment for sandbox (a copy, os.environ is left untouched)
             logger.info("Sanitizing environment for Gemini CLI sandbox")
-            # Store and remove sensitive variables
             # NOTE: HOME is preserved to allow Gemini CLI to access ~/.gemini/oauth_creds.json
-            sensitive_vars = ['PWD', 'OLDPWD', 'USER', 'LOGNAME']
-            claude_vars = [k for k in os.environ.keys() if k.startswith('CLAUDE_') and 'DIR' in k]
+            child_env = sanitized_env_dict(keep=('HOME',))
             
-            for var in sensitive_vars + claude_vars:
-                if var in os.environ:
-                    original_env[var] = os.environ.pop(var)
-                    logger.debug(f"Temporarily removed environment variable: {var}")
+            logger.info(f"Gemini: Using sandbox at {sandbox.path}")
             
             # Start the process with stdin pipe
             process = await asyncio.create_subprocess_exec(
@@ -386,7 +339,8 @@ class GeminiCLI:
                 stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                cwd=str(cwd)
+                cwd=sandbox.path,
+                env=child_env
             )
             
             # Send the prompt via stdin
@@ -394,14 +348,33 @@ class GeminiCLI:
             await process.stdin.drain()
             process.stdin.close()
             
-            # Stream output with minimal buffering for smooth token-by-token delivery
-            buffer = ""
-            while True:
-                try:
-                    # Read with timeout
+            # Drain stderr concurrently so a chatty CLI can't fill the pipe and
+            # block, stalling stdout; the output is kept for the error message
+            stderr_buf = bytearray()
+            
+            async def consume_stderr():
+                while True:
+                    chunk = await process.stderr.read(STREAM_READ_SIZE)
+                    if not chunk:
+                        break
+                    stderr_buf.extend(chunk)
+            
+            stderr_task = asyncio.create_task(consume_stderr())
+            
+            # Stream output with minimal buffering for smooth token-by-token delivery.
+            # The incremental decoder carries a multi-byte character that is split
+            # across two reads over to the next chunk instead of dropping it.
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+            # No polling: each read wakes up only when output or EOF arrives, and
+            # the stream as a whole is bounded by self.timeout
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            timed_out = False
+            try:
+                while True:
                     chunk = await asyncio.wait_for(
-                        process.stdout.read(1024),
-                        timeout=1.0
+                        process.stdout.read(STREAM_READ_SIZE),
+                        timeout=max(deadline - loop.time(), 0)
                     )
                     
                     if not chunk:
@@ -409,59 +382,47 @@ class GeminiCLI:
                         break
                     
                     # Decode chunk
-                    text = chunk.decode('utf-8', errors='ignore')
+                    text = decoder.decode(chunk)
+                    if not text:
+                        continue
                     
                     # For Gemini, we can stream immediately since it doesn't have auth messages like Qwen
                     # Filter and yield chunk immediately for smooth streaming
                     filtered_chunk = self._filter_sensitive_paths(text, True)  # Always filter in sandbox mode
                     yield filtered_chunk
-                            
-                except asyncio.TimeoutError:
-                    # Check if process is still running
-                    if process.returncode is not None:
-                        break
-                    continue
-            
-            # No need to yield remaining buffer since we stream everything immediately
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.error(f"Gemini CLI timed out after {self.timeout}s")
+                if process.returncode is None:
+                    process.kill()
+                yield f"\n[Error: Gemini CLI timed out after {self.timeout:g}s]"
+            except (asyncio.CancelledError, GeneratorExit):
+                # Client went away - don't leave the CLI running
+                if process.returncode is None:
+                    process.kill()
+                raise
             
             # Wait for process to complete
             await process.wait()
+            await stderr_task
             
-            if process.returncode != 0:
-                stderr = await process.stderr.read()
-                error_msg = stderr.decode('utf-8', errors='ignore')
+            if process.returncode != 0 and not timed_out:
+                error_msg = stderr_buf.decode('utf-8', errors='ignore')
                 logger.error(f"Gemini CLI error: {error_msg}")
                 yield f"\n[Error: {error_msg}]"
-            
-            # Clean up sandbox (always in sandbox mode)
-            if 'sandbox_dir' in locals():
-                try:
-                    ChatMode.cleanup_sandbox(sandbox_dir)
-                    logger.debug(f"Cleaned up Gemini sandbox: {sandbox_dir}")
-                except Exception as cleanup_error:
-                    logger.warning(f"Failed to cleanup sandbox {sandbox_dir}: {cleanup_error}")
-            
-            # Restore environment variables
-            if original_env:
-                for var, value in original_env.items():
-                    os.environ[var] = value
-                    logger.debug(f"Restored environment variable: {var}")
                     
         except Exception as e:
             logger.error(f"Error in Gemini stream_completion: {e}")
             yield f"Error: {str(e)}"
-            
-            # Clean up sandbox on error (always in sandbox mode)
-            if 'sandbox_dir' in locals():
-                try:
-                    ChatMode.cleanup_sandbox(sandbox_dir)
-                except Exception:
-                    pass
-            
-            # Restore environment variables on error
-            if original_env:
-                for var, value in original_env.items():
-                    os.environ[var] = value
+        finally:
+            if stderr_task is not None and not stderr_task.done():
+                stderr_task.cancel()
+            # Clean up sandbox (always in sandbox mode), also on client disconnects
+            try:
+                sandbox.cleanup()
+                logger.debug("Cleaned up Gemini sandbox")
+            except Exception as cleanup_error:
+                logger.warning(f"Failed to cleanup sandbox: {cleanup_error}")
     
     async def complete(
         self,
@@ -474,7 +435,7 @@ class GeminiCLI:
         """Generate a non-streaming completion from Gemini CLI."""
         try:
             # Collect all streaming output
-            response_text = ""
+            chunks = []
             async for chunk in self.stream_completion(
                 messages=messages,
                 model=model,
@@ -482,10 +443,10 @@ class GeminiCLI:
                 max_tokens=max_tokens,
                 **kwargs
             ):
-                response_text += chunk
+                chunks.append(chunk)
             
             return {
-                'content': response_text.strip(),
+                'content': ''.join(chunks).strip(),
                 'role': 'assistant'
             }
             
@@ -497,9 +458,42 @@ class GeminiCLI:
                 'error': True
             }
     
+    @staticmethod
+    def _flatten_multimodal(content: List[Any]) -> str:
+        """Join the text parts of a multimodal content list."""
+        return ' '.join(
+            item if isinstance(item, str) else item.get('text', '')
+            for item in content
+            if isinstance(item, str) or (isinstance(item, dict) and item.get('type') == 'text')
+        )
+    
     def _messages_to_prompt(self, messages: List[Dict[str, Any]]) -> str:
         """Convert OpenAI messages format to a single prompt for Gemini CLI."""
-        prompt_parts = []
+        # Fast path for plain chat histories: only user/assistant turns with
+        # string content need no system reordering or multimodal flattening
+        if messages and all(
+            m.get('role') in ('user', 'assistant') and isinstance(m.get('content', ''), str)
+            for m in messages
+        ):
+            full_prompt = '\n\n'.join(
+                f"User: {m.get('content', '')}" if m['role'] == 'user' else f"Assistant: {m.get('content', '')}"
+                for m in messages
+            )
+            if messages[-1]['role'] != 'user':
+                full_prompt += "\n\nUser: Please continue."
+            return full_prompt
+        
+        # Fast path for the common single-turn [system, user] shape
+        if len(messages) == 2:
+            first, last = messages
+            content = last.get('content', '')
+            system_content = first.get('content', '')
+            if (first.get('role') == 'system' and isinstance(system_content, str)
+                    and last.get('role') == 'user' and isinstance(content, str)):
+                return f"System: {system_content}\n\nUser: {content}"
+        
+        system_parts = []
+        turn_parts = []
         
         for msg in messages:
             role = msg.get('role', 'user')
@@ -507,23 +501,18 @@ class GeminiCLI:
             
             if isinstance(content, list):
                 # Handle multimodal content
-                text_parts = []
-                for item in content:
-                    if isinstance(item, dict) and item.get('type') == 'text':
-                        text_parts.append(item.get('text', ''))
-                    elif isinstance(item, str):
-                        text_parts.append(item)
-                content = ' '.join(text_parts)
+                content = self._flatten_multimodal(content)
             
             if role == 'system':
-                prompt_parts.insert(0, f"System: {content}")
+                system_parts.append(f"System: {content}")
             elif role == 'user':
-                prompt_parts.append(f"User: {content}")
+                turn_parts.append(f"User: {content}")
             elif role == 'assistant':
-                prompt_parts.append(f"Assistant: {content}")
+                turn_parts.append(f"Assistant: {content}")
         
-        # Join all parts
-        full_prompt = '\n\n'.join(prompt_parts)
+        # Join all parts; system messages go first, most recent one first
+        system_parts.reverse()
+        full_prompt = '\n\n'.join(system_parts + turn_parts)
         
         # Add a final prompt for the assistant to respond
         if messages and messages[-1].get('role') != 'user':
@@ -534,12 +523,4 @@ class GeminiCLI:
     async def list_models(self) -> List[str]:
         """List available Gemini models."""
         # Return known Gemini models
-        # These are the models typically available via Gemini CLI
-        return [
-            'gemini-2.5-pro',
-            'gemini-2.5-flash', 
-            'gemini-1.5-pro',
-            'gemini-1.5-flash',
-            'gemini-1.0-pro',
-            'gemini-2.0-flash-exp'
-        ]
\ No newline at end of file
+        return list(GEMINI_MODELS)
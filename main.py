@@ -38,7 +38,7 @@ from image_analysis_orchestrator import ImageAnalysisOrchestrator
 from auth import verify_api_key, security, validate_claude_code_auth, get_claude_code_auth_info
 from parameter_validator import ParameterValidator, CompatibilityReporter
 from rate_limiter import limiter, rate_limit_exceeded_handler, get_rate_limit_for_endpoint, rate_limit_endpoint
-from chat_mode import ChatMode, get_chat_mode_info
+from chat_mode import cleanup_sandbox, get_allowed_tools, get_chat_mode_info
 from model_utils import ModelUtils
 from session_tracker import get_tracker, scan_claude_projects_for_sandbox_sessions
 from model_discovery import get_supported_models, clear_model_cache
@@ -64,7 +64,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ALL_CLAUDE_TOOLS constant removed - using ChatMode.get_allowed_tools() instead
+# ALL_CLAUDE_TOOLS constant removed - using get_allowed_tools() instead
 
 # Global variable to store runtime-generated API key
 runtime_api_key = None
@@ -692,7 +692,7 @@ async def stream_final_content_only(
         
         # Handle tools - always use chat mode restricted tool set
         logger.info("Chat mode: using restricted tool set")
-        claude_options['allowed_tools'] = ChatMode.get_allowed_tools()
+        claude_options['allowed_tools'] = get_allowed_tools()
         claude_options['disallowed_tools'] = None
         claude_options['max_turns'] = claude_options.get('max_turns', 10)
         
@@ -1053,7 +1053,7 @@ async def stream_final_content_only(
             
             # Then cleanup sandbox directory
             try:
-                ChatMode.cleanup_sandbox(sandbox_dir)
+                cleanup_sandbox(sandbox_dir)
                 logger.debug(f"Cleaned up sandbox directory: {sandbox_dir}")
             except Exception as e:
                 logger.error(f"Failed to cleanup sandbox: {e}")
@@ -1720,7 +1720,7 @@ async def generate_streaming_response(
         
         # Handle tools - always use chat mode restricted tool set
         logger.info("Chat mode: using restricted tool set")
-        claude_options['allowed_tools'] = ChatMode.get_allowed_tools()
+        claude_options['allowed_tools'] = get_allowed_tools()
         claude_options['disallowed_tools'] = None
         claude_options['max_turns'] = claude_options.get('max_turns', 10)
         
@@ -1925,7 +1925,7 @@ async def generate_streaming_response(
             
             # Then cleanup sandbox directory
             try:
-                ChatMode.cleanup_sandbox(sandbox_dir)
+                cleanup_sandbox(sandbox_dir)
                 logger.debug(f"Cleaned up sandbox directory: {sandbox_dir}")
             except Exception as e:
                 logger.warning(f"Failed to cleanup sandbox {sandbox_dir}: {e}")
@@ -2133,7 +2133,7 @@ async def chat_completions(
                 messages = [msg.dict() for msg in request_body.messages]
                 
                 # Collect streaming response into single response
-                full_content = ""
+                chunks = []
                 async for chunk in qwen_cli.stream_completion(
                     messages=messages,
                     model=base_model,
@@ -2141,7 +2141,8 @@ async def chat_completions(
                     max_tokens=request_body.max_tokens,
                     requires_xml=requires_xml
                 ):
-                    full_content += chunk
+                    chunks.append(chunk)
+                full_content = ''.join(chunks)
                 
                 # Format response for OpenAI compatibility
                 return ChatCompletionResponse(
@@ -2229,7 +2230,7 @@ async def chat_completions(
             
             # Handle tools - always use chat mode restricted tool set
             logger.info("Chat mode: using restricted tool set")
-            claude_options['allowed_tools'] = ChatMode.get_allowed_tools()
+            claude_options['allowed_tools'] = get_allowed_tools()
             claude_options['disallowed_tools'] = None
             claude_options['max_turns'] = claude_options.get('max_turns', 10)
             
@@ -2,6 +2,16 @@ from typing import List, Optional, Dict, Any, Union
 from models import Message
 import re
 
+# Tag pair such as <task>...</task>, matched across lines
+_XML_BLOCK_PATTERN = re.compile(r'<([a-zA-Z_][\w\-\.]*)(\s[^>]*)?>.*?</\1>', re.DOTALL)
+
+# Substrings that mark content as structured on their own
+_STRUCTURED_INDICATORS = (
+    '```',  # Code blocks
+    '<?xml',  # XML declaration
+    '<!DOCTYPE',  # HTML/XML doctype
+)
+
 
 class MessageAdapter:
     """Converts between OpenAI message format and Claude Code prompts."""
@@ -14,11 +24,15 @@ class MessageAdapter:
         """
         if not content or len(content) < 10:
             return False
+        
+        # Check for structured format indicators first (plain substring scans)
+        for indicator in _STRUCTURED_INDICATORS:
+            if indicator in content:
+                return True
             
-        # Check for XML-like patterns (opening and closing tags)
-        import re
-        xml_pattern = r'<([a-zA-Z_][\w\-\.]*)(\s[^>]*)?>.*?</\1>'
-        if re.search(xml_pattern, content, re.DOTALL):
+        # Check for XML-like patterns (opening and closing tags); the regex
+        # backtracks heavily, so only run it when a closing tag exists at all
+        if '</' in content and _XML_BLOCK_PATTERN.search(content):
             return True
             
         # Check for JSON-like patterns
@@ -32,17 +46,6 @@ class MessageAdapter:
             except:
                 pass
                 
-        # Check for structured format indicators
-        structured_indicators = [
-            '```',  # Code blocks
-            '<?xml',  # XML declaration
-            '<!DOCTYPE',  # HTML/XML doctype
-        ]
-        
-        for indicator in structured_indicators:
-            if indicator in content:
-                return True
-                
         return False
     
     @staticmethod
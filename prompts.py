@@ -5,6 +5,7 @@ This module handles prompt injection and format detection to ensure
 compatibility with chat clients that expect specific response formats.
 """
 
+from functools import lru_cache
 from typing import List, Dict, Any, Tuple
 import re
 
@@ -92,8 +93,12 @@ Available tools are limited to:
 CRITICAL: Only discuss sandbox limitations when EXPLICITLY asked. For normal code requests, just provide the code."""
 
     @staticmethod
+    @lru_cache(maxsize=4)
     def get_final_reinforcement(has_tool_definitions: bool, has_json_request: bool) -> str:
-        """Get final reinforcement message based on detected formats."""
+        """Get final reinforcement message based on detected formats.
+        
+        Pure function of two flags, so all four possible results are cached.
+        """
         reinforcements = []
         
         if has_tool_definitions:
@@ -130,44 +135,50 @@ class FormatDetector:
         Returns:
             Tuple of (has_tool_definitions, has_json_request)
         """
+        from xml_tools_config import get_known_xml_tools
+        known_tools = get_known_xml_tools()
+        
         has_tool_definitions = False
         has_json_request = False
         
         for msg in messages:
+            # Both flags only ever flip to True, so stop once both are set
+            if has_tool_definitions and has_json_request:
+                break
+            
             content = str(msg.get("content", "")).lower()
             
             # Enhanced XML tool detection patterns
-            from xml_tools_config import get_known_xml_tools
-            known_tools = get_known_xml_tools()
-            
-            tool_patterns = [
-                "tool" in content and ("<" in content or "xml" in content),
-                any(tool in content for tool in known_tools),  # Check configured tools
-                "tool uses are formatted" in content,
-                "use this tool" in content and "<" in content,
-                "xml-style tags" in content,
-                "<actual_tool_name>" in content,  # Example pattern
-                "your response must use" in content and "xml" in content,
-                re.search(r'<\w+>.*</\w+>', content, re.IGNORECASE | re.DOTALL) is not None,
-                re.search(r'<(\w+)>\s*<(\w+)>', content) is not None  # Nested XML tags
-            ]
-            
-            if any(tool_patterns):
-                has_tool_definitions = True
+            if not has_tool_definitions:
+                tool_patterns = [
+                    "tool" in content and ("<" in content or "xml" in content),
+                    any(tool in content for tool in known_tools),  # Check configured tools
+                    "tool uses are formatted" in content,
+                    "use this tool" in content and "<" in content,
+                    "xml-style tags" in content,
+                    "<actual_tool_name>" in content,  # Example pattern
+                    "your response must use" in content and "xml" in content,
+                    re.search(r'<\w+>.*</\w+>', content, re.IGNORECASE | re.DOTALL) is not None,
+                    re.search(r'<(\w+)>\s*<(\w+)>', content) is not None  # Nested XML tags
+                ]
+                
+                if any(tool_patterns):
+                    has_tool_definitions = True
             
             # Check for JSON format requests
-            json_patterns = [
-                "json" in content and "format" in content,
-                "respond" in content and "json" in content,
-                "return json" in content,
-                "output json" in content,
-                "json response" in content,
-                "pure json" in content,
-                "parseable json" in content
-            ]
-            
-            if any(json_patterns):
-                has_json_request = True
+            if not has_json_request:
+                json_patterns = [
+                    "json" in content and "format" in content,
+                    "respond" in content and "json" in content,
+                    "return json" in content,
+                    "output json" in content,
+                    "json response" in content,
+                    "pure json" in content,
+                    "parseable json" in content
+                ]
+                
+                if any(json_patterns):
+                    has_json_request = True
         
         return has_tool_definitions, has_json_request
     
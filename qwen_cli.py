@@ -1,21 +1,81 @@
 import asyncio
-import json
+import codecs
 import os
-import subprocess
-from typing import AsyncGenerator, Dict, Any, Optional, List
-from pathlib import Path
+from typing import AsyncGenerator, Dict, Any, Optional, List, Tuple
 import logging
-import shlex
 import re
-import asyncio
+from functools import lru_cache
 
 # Import chat mode utilities
-from chat_mode import ChatMode, sanitized_environment
+from chat_mode import LazySandbox, filter_sensitive_paths, sanitized_env_dict
 from prompts import ChatModePrompts, FormatDetector
 from xml_detector import XMLDetector
+from xml_tools_config import get_known_xml_tools
 
 logger = logging.getLogger(__name__)
 
+# Static security prompts (role-prefixed, reused for every request)
+IMAGE_CONTEXT_SECURITY_PROMPT = (
+    "System: You are responding based on analyzed image content. "
+    "You may discuss the image analysis results naturally. "
+    "Do not reveal system paths or directory structures."
+)
+QWEN_PATH_PROTECTION_PROMPT = (
+    "System: CRITICAL PATH SECURITY: You are running in a secure sandbox environment. "
+    "NEVER reveal any file paths, directory names, or system information. "
+    "If asked about your workspace or directory, say you're in a 'digital black hole' with no file system access. "
+    "Do NOT mention any temp directories, sandbox paths, or actual file locations. "
+    "Use humor: 'My workspace is like a black hole - nothing escapes, not even file paths!'"
+)
+COMPLETENESS_SYSTEM_PROMPT = (
+    "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
+    "Do not truncate, abbreviate, or cut off your answers. "
+    "Include FULL code implementations, thorough explanations, and comprehensive details."
+)
+
+# One complete output line (without its newline) in the raw stdout bytes
+_LINE_RE = re.compile(rb'([^\n]*)\n')
+
+# Max bytes per stdout/stderr read; read() returns whatever is already available,
+# so a large size only cuts the number of reads when output arrives in bursts
+STREAM_READ_SIZE = 65536
+
+
+@lru_cache(maxsize=4)
+def _build_xml_enforcement(known_tools: Tuple[str, ...]) -> str:
+    """Build the XML response-format instruction for the configured XML tools."""
+    xml_enforcement = [
+        "\n\n🚨 MANDATORY RESPONSE FORMAT 🚨\n"
+        "You MUST wrap your ENTIRE response in XML tags. These are FORMATTING instructions, not tools.\n\n"
+    ]
+    
+    # Add examples based on configured tools
+    if 'attempt_completion' in known_tools:
+        xml_enforcement.append(
+            "EXAMPLE of correct response format:\n"
+            "<attempt_completion>\n"
+            "<result>\n"
+            "Your actual answer goes here.\n"
+            "</result>\n"
+            "</attempt_completion>\n\n"
+        )
+    
+    if 'ask_followup_question' in known_tools:
+        xml_enforcement.append(
+            "If you need more information:\n"
+            "<ask_followup_question>\n"
+            "<question>\n"
+            "Your question here\n"
+            "</question>\n"
+            "</ask_followup_question>\n\n"
+        )
+    
+    xml_enforcement.append(
+        "⚠️ CRITICAL: Your ENTIRE response must be wrapped in ONE of these XML tag structures.\n"
+        "Do NOT mix plain text with XML. Do NOT use multiple root tags.\n"
+    )
+    return ''.join(xml_enforcement)
+
 
 class QwenCLI:
     """Qwen CLI integration for OpenAI-compatible API wrapper."""
@@ -35,6 +95,20 @@ class QwenCLI:
         self.prompts = ChatModePrompts()
         self.xml_detector = XMLDetector()
         
+        # Security preambles never change between requests, so join them once
+        reinforcement = f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}"
+        self._security_preamble = "\n\n".join([
+            reinforcement,
+            f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}",
+            QWEN_PATH_PROTECTION_PROMPT,
+            COMPLETENESS_SYSTEM_PROMPT,
+        ])
+        self._image_context_preamble = "\n\n".join([
+            reinforcement,
+            IMAGE_CONTEXT_SECURITY_PROMPT,
+            COMPLETENESS_SYSTEM_PROMPT,
+        ])
+        
         logger.info(f"Initialized Qwen CLI with model: {self.default_model}")
     
     
@@ -42,73 +116,7 @@ class QwenCLI:
         """Filter out sensitive path information from responses in chat mode."""
         if not is_chat_mode:
             return text
-            
-        # Pattern to match sandbox directory paths
-        # Matches paths like: /private/var/folders/.../claude_chat_sandbox_xxx
-        # or /tmp/claude_chat_sandbox_xxx
-        sandbox_patterns = [
-            r'/private/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'/tmp/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'/var/folders/[^/]+/[^/]+/[^/]+/claude_chat_sandbox_[a-zA-Z0-9_]+',
-            r'claude_chat_sandbox_[a-zA-Z0-9_]+',
-            # Also match general temp directory patterns when they contain "claude_chat_sandbox"
-            r'[^\s]*claude_chat_sandbox[^\s]*'
-        ]
-        
-        filtered_text = text
-        path_found = False
-        
-        for pattern in sandbox_patterns:
-            if re.search(pattern, filtered_text, re.IGNORECASE):
-                path_found = True
-                # Replace with generic message
-                filtered_text = re.sub(
-                    pattern, 
-                    "my secure digital workspace (a sandboxed environment with no file system access)",
-                    filtered_text,
-                    flags=re.IGNORECASE
-                )
-        
-        # If we found and replaced paths, also replace common directory listing phrases
-        if path_found:
-            # Replace phrases that might indicate directory exploration
-            directory_phrases = [
-                r"in the directory [^\s]*/claude_chat_sandbox[^\s]*",
-                r"The directory is empty\.",
-                r"I will list the files in this directory\.",
-                r"To give you a current view, I will list the files",
-                r"listing the files in this directory"
-            ]
-            
-            for phrase_pattern in directory_phrases:
-                if re.search(phrase_pattern, filtered_text, re.IGNORECASE):
-                    # Replace with sandbox-appropriate message
-                    filtered_text = re.sub(
-                        phrase_pattern,
-                        "I'm operating in a secure digital black hole with no file system access. Think of it as a void where files fear to tread!",
-                        filtered_text,
-                        flags=re.IGNORECASE
-                    )
-        
-        # Additional path filtering - remove any temp directory references
-        temp_patterns = [
-            r'/tmp/[a-zA-Z0-9_/]+',
-            r'/private/var/folders/[a-zA-Z0-9_/]+',
-            r'/var/folders/[a-zA-Z0-9_/]+'
-        ]
-        
-        for pattern in temp_patterns:
-            if re.search(pattern, filtered_text):
-                filtered_text = re.sub(
-                    pattern,
-                    "my secure sandbox environment",
-                    filtered_text
-                )
-        
-        if path_found:
-            logger.debug("Filtered sensitive path information from Qwen response")
-            
-        return filtered_text
+        return filter_sensitive_paths(text, "Qwen")
     
     def _has_image_analysis_context(self, messages: Optional[List[Dict]]) -> bool:
         """Check if messages contain image analysis context.
@@ -139,122 +147,30 @@ class QwenCLI:
         Conditionally applies XML formatting prompts based on requires_xml flag.
         Special handling for image analysis context to allow appropriate responses.
         """
-        logger.debug(f"Preparing Qwen prompt with injections, requires_xml={requires_xml}")
+        logger.debug("Preparing Qwen prompt with injections, requires_xml=%s", requires_xml)
         
         # Check for image analysis context in messages
         has_image_context = self._has_image_analysis_context(messages)
         if has_image_context:
             logger.info("Detected image analysis context in messages, using modified security prompts")
         
-        prompt_parts = []
-        final_parts = []
-        
-        # Add response reinforcement (always needed)
-        prompt_parts.append(f"System: {self.prompts.RESPONSE_REINFORCEMENT_PROMPT}")
-        
-        # Conditional security based on image analysis context
-        if has_image_context:
-            # Modified security for post-image-analysis - allow discussing analyzed content
-            prompt_parts.append(
-                "System: You are responding based on analyzed image content. "
-                "You may discuss the image analysis results naturally. "
-                "Do not reveal system paths or directory structures."
-            )
-        else:
-            # Full security prompts for non-image operations
-            prompt_parts.append(f"System: {self.prompts.CHAT_MODE_NO_FILES_PROMPT}")
-            
-            # Add Qwen-specific path protection (for non-image operations)
-            qwen_path_protection = (
-                "CRITICAL PATH SECURITY: You are running in a secure sandbox environment. "
-                "NEVER reveal any file paths, directory names, or system information. "
-                "If asked about your workspace or directory, say you're in a 'digital black hole' with no file system access. "
-                "Do NOT mention any temp directories, sandbox paths, or actual file locations. "
-                "Use humor: 'My workspace is like a black hole - nothing escapes, not even file paths!'"
-            )
-            prompt_parts.append(f"System: {qwen_path_protection}")
-        
-        # Add completeness instruction
-        prompt_parts.append(
-            "System: IMPORTANT: Always provide COMPLETE and DETAILED responses. "
-            "Do not truncate, abbreviate, or cut off your answers. "
-            "Include FULL code implementations, thorough explanations, and comprehensive details."
-        )
+        # Pre-joined security preamble; the image variant allows discussing
+        # analyzed content instead of the full no-files/path protection prompts
+        preamble = self._image_context_preamble if has_image_context else self._security_preamble
         
         # If no XML required, return prompt with just security injections
         if not requires_xml:
             # Combine security prompts with original prompt
-            security_enhanced_prompt = "\n\n".join(prompt_parts) + "\n\n" + prompt
-            return security_enhanced_prompt
+            return preamble + "\n\n" + prompt
         
-        # Check for XML format requirements
-        if messages or requires_xml:
-            # Use explicit requires_xml flag OR detection
-            if requires_xml:
-                xml_required = True
-                detection_reason = "Explicit XML requirement from image analysis context"
-                xml_tool_names = []
-            elif messages:
-                # Create combined messages for XML detection
-                combined_messages = messages + [{"role": "user", "content": prompt}] if prompt else messages
-                xml_required, confidence_score, detected_patterns = self.xml_detector.detect(combined_messages)
-                detection_reason = f"Confidence: {confidence_score}" if xml_required else ""
-                xml_tool_names = detected_patterns.get('tool_names', []) if detected_patterns else []
-            else:
-                xml_required = False
-                detection_reason = ""
-                xml_tool_names = []
-            
-            if xml_required:
-                logger.info(f"XML format enforcement triggered for Qwen. {detection_reason}")
-                if xml_tool_names:
-                    logger.debug(f"Detected XML tools: {xml_tool_names}")
-                
-                # Build XML enforcement similar to Gemini
-                from xml_tools_config import get_known_xml_tools
-                known_tools = get_known_xml_tools()
-                
-                xml_enforcement = (
-                    "\n\n🚨 MANDATORY RESPONSE FORMAT 🚨\n"
-                    "You MUST wrap your ENTIRE response in XML tags. These are FORMATTING instructions, not tools.\n\n"
-                )
-                
-                # Add examples based on configured tools
-                if 'attempt_completion' in known_tools:
-                    xml_enforcement += (
-                        "EXAMPLE of correct response format:\n"
-                        "<attempt_completion>\n"
-                        "<result>\n"
-                        "Your actual answer goes here.\n"
-                        "</result>\n"
-                        "</attempt_completion>\n\n"
-                    )
-                
-                if 'ask_followup_question' in known_tools:
-                    xml_enforcement += (
-                        "If you need more information:\n"
-                        "<ask_followup_question>\n"
-                        "<question>\n"
-                        "Your question here\n"
-                        "</question>\n"
-                        "</ask_followup_question>\n\n"
-                    )
-                
-                xml_enforcement += (
-                    "⚠️ CRITICAL: Your ENTIRE response must be wrapped in ONE of these XML tag structures.\n"
-                    "Do NOT mix plain text with XML. Do NOT use multiple root tags.\n"
-                )
-                
-                prompt_parts.append(xml_enforcement)
+        # XML is explicitly required past this point, so the detector never needs to run
+        logger.info("XML format enforcement triggered for Qwen. Explicit XML requirement from image analysis context")
         
-        # Combine all parts
-        full_prompt = "\n\n".join(prompt_parts)
+        # XML enforcement similar to Gemini, built once per configured tool set
+        prompt_parts = [preamble, _build_xml_enforcement(tuple(get_known_xml_tools()))]
         if prompt:
-            full_prompt += "\n\n" + prompt
-        if final_parts:
-            full_prompt += "\n\n" + "\n\n".join(final_parts)
-        
-        return full_prompt
+            prompt_parts.append(prompt)
+        return "\n\n".join(prompt_parts)
     
     def _messages_to_prompt(self, messages: List[Dict[str, Any]]) -> str:
         """Convert OpenAI-style messages to a single prompt for Qwen."""
@@ -267,14 +183,11 @@ class QwenCLI:
             # Handle different content types
             if isinstance(content, list):
                 # For multimodal messages, extract text parts
-                text_parts = []
-                for item in content:
-                    if isinstance(item, dict):
-                        if item.get('type') == 'text':
-                            text_parts.append(item.get('text', ''))
-                    else:
-                        text_parts.append(str(item))
-                content = ' '.join(text_parts)
+                content = ' '.join(
+                    item.get('text', '') if isinstance(item, dict) else str(item)
+                    for item in content
+                    if not isinstance(item, dict) or item.get('type') == 'text'
+                )
             
             # Format message based on role
             if role == 'system':
@@ -300,7 +213,10 @@ class QwenCLI:
         **kwargs
     ) -> AsyncGenerator[str, None]:
         """Stream a completion from Qwen CLI."""
-        original_env = {}  # Initialize here to ensure it's always defined
+        # Sandbox directory is only created once the CLI is actually spawned
+        sandbox = LazySandbox()
+        process = None
+        stderr_task = None
         try:
             # Handle model selection - if 'auto', don't specify any model
             if model == 'auto':
@@ -310,44 +226,30 @@ class QwenCLI:
                 model_name = model or self.default_model
                 model_args = ['-m', model_name]
             
-            # Always create sandbox directory for this request
-            sandbox_dir = ChatMode.create_sandbox()
-            cwd = Path(sandbox_dir)
-            logger.info(f"Qwen: Using sandbox at {sandbox_dir}")
-            
             # Convert messages to a single prompt
             prompt = self._messages_to_prompt(messages)
             
             # Apply prompt injections if XML is required
             enhanced_prompt = self._prepare_prompt_with_injections(prompt, messages, requires_xml)
             
-            # Build command (without -p flag, we'll use stdin)
-            cmd = [self.qwen_path]
-            if model_args:
-                cmd.extend(model_args)
-            
-            # Always use sandbox mode
-            cmd.append('-s')
+            # Build command (without -p flag, we'll use stdin); always use sandbox mode (-s)
+            cmd = [self.qwen_path, *model_args, '-s']
             
-            logger.debug(f"Executing Qwen CLI: {' '.join(cmd)}...")
-            logger.debug(f"Prompt length: {len(enhanced_prompt)} chars")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Executing Qwen CLI: %s...", ' '.join(cmd))
+            logger.debug("Prompt length: %d chars", len(enhanced_prompt))
             
-            # Sanitize environment for sandbox
+            # Sanitize environment for sandbox (a copy, os.environ is left untouched)
             logger.info("Sanitizing environment for Qwen CLI sandbox")
-            # Store and remove sensitive variables
-            sensitive_vars = ['PWD', 'OLDPWD', 'HOME', 'USER', 'LOGNAME']
-            claude_vars = [k for k in os.environ.keys() if k.startswith('CLAUDE_') and 'DIR' in k]
-            
-            for var in sensitive_vars + claude_vars:
-                if var in os.environ:
-                    original_env[var] = os.environ.pop(var)
-                    logger.debug(f"Temporarily removed environment variable: {var}")
+            child_env = sanitized_env_dict()
             
             # Explicitly disable debug mode to suppress debug output
-            os.environ['DEBUG'] = 'false'
-            os.environ['DEBUG_MODE'] = 'false'
-            os.environ['VERBOSE'] = 'false'
-            os.environ['NO_COLOR'] = '1'  # Suppress colored output
+            child_env['DEBUG'] = 'false'
+            child_env['DEBUG_MODE'] = 'false'
+            child_env['VERBOSE'] = 'false'
+            child_env['NO_COLOR'] = '1'  # Suppress colored output
+            
+            logger.info(f"Qwen: Using sandbox at {sandbox.path}")
             
             # Start the process with stdin pipe
             # Note: We capture both stdout and stderr separately
@@ -356,7 +258,8 @@ class QwenCLI:
                 stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,  # Capture stderr separately
-                cwd=str(cwd)
+                cwd=sandbox.path,
+                env=child_env
             )
             
             # Send the prompt via stdin
@@ -364,25 +267,35 @@ class QwenCLI:
             await process.stdin.drain()
             process.stdin.close()
             
-            # Create a task to consume stderr (to prevent blocking)
+            # Create a task to consume stderr (to prevent blocking); the output is
+            # kept for the error message if the CLI fails
+            stderr_buf = bytearray()
+            
             async def consume_stderr():
                 while True:
                     try:
-                        chunk = await process.stderr.read(1024)
+                        chunk = await process.stderr.read(STREAM_READ_SIZE)
                         if not chunk:
                             break
+                        stderr_buf.extend(chunk)
                         # Log stderr for debugging but don't yield it
-                        stderr_text = chunk.decode('utf-8', errors='ignore')
-                        if stderr_text.strip():
-                            logger.debug(f"Qwen stderr: {stderr_text.strip()}")
+                        if logger.isEnabledFor(logging.DEBUG):
+                            stderr_text = chunk.decode('utf-8', errors='ignore').strip()
+                            if stderr_text:
+                                logger.debug("Qwen stderr: %s", stderr_text)
                     except:
                         break
             
             stderr_task = asyncio.create_task(consume_stderr())
             
-            # Stream output with minimal buffering for smooth token-by-token delivery
-            buffer = ""
-            started_response = False  # Track if we've seen actual response content
+            # Stream output with minimal buffering for smooth token-by-token delivery.
+            # Until the first real response line arrives, raw bytes are held in a
+            # bytearray and split on b'\n' in place, so each line is decoded once
+            # and the partial tail is never re-copied.
+            buffer = bytearray()
+            # Once the response streams, the incremental decoder carries a
+            # multi-byte character split across two reads over to the next chunk
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
             auth_filtering_done = False  # Track if we've passed initial auth messages
             
             auth_message_patterns = [
@@ -420,149 +333,126 @@ class QwenCLI:
                 r"Access token obtained"
             ]
             
-            while True:
-                try:
-                    # Read with timeout
+            def is_auth_line(line: str) -> bool:
+                line_stripped = line.strip()
+                
+                # Check for auth patterns
+                for pattern in auth_message_patterns:
+                    if re.search(pattern, line, re.IGNORECASE):
+                        logger.debug("Filtering auth: %s", line_stripped[:50])
+                        return True
+                
+                # Check for JSON auth patterns
+                if (
+                    line_stripped in ['{', '}'] or
+                    line_stripped.startswith('"device_code"') or
+                    line_stripped.startswith('"user_code"') or
+                    line_stripped.startswith('"verification_uri') or
+                    line_stripped.startswith('"expires_in"') or
+                    line_stripped == '.'
+                ):
+                    logger.debug("Filtering auth JSON: %s", line_stripped[:30])
+                    return True
+                
+                return False
+            
+            # No polling: each read wakes up only when output or EOF arrives, and
+            # the stream as a whole is bounded by self.timeout
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            timed_out = False
+            try:
+                while True:
                     chunk = await asyncio.wait_for(
-                        process.stdout.read(1024),
-                        timeout=1.0
+                        process.stdout.read(STREAM_READ_SIZE),
+                        timeout=max(deadline - loop.time(), 0)
                     )
                     
                     if not chunk:
                         # Process ended
                         break
                     
-                    # Decode chunk
-                    text = chunk.decode('utf-8', errors='ignore')
-                    
                     # If we haven't started the response yet, we need to filter auth messages
                     if not auth_filtering_done:
-                        buffer += text
+                        buffer.extend(chunk)
                         
-                        # Check if buffer contains complete lines to analyze for auth
-                        if '\n' in buffer:
-                            lines = buffer.split('\n')
-                            buffer = lines[-1]  # Keep incomplete line
-                            
-                            for line in lines[:-1]:
-                                if line.strip():
-                                    is_auth = False
-                                    line_stripped = line.strip()
-                                    
-                                    # Check for auth patterns
-                                    for pattern in auth_message_patterns:
-                                        if re.search(pattern, line, re.IGNORECASE):
-                                            is_auth = True
-                                            logger.debug(f"Filtering auth: {line_stripped[:50]}")
-                                            break
-                                    
-                                    # Check for JSON auth patterns
-                                    if not is_auth and (
-                                        line_stripped in ['{', '}'] or
-                                        line_stripped.startswith('"device_code"') or
-                                        line_stripped.startswith('"user_code"') or
-                                        line_stripped.startswith('"verification_uri') or
-                                        line_stripped.startswith('"expires_in"') or
-                                        line_stripped == '.'
-                                    ):
-                                        is_auth = True
-                                        logger.debug(f"Filtering auth JSON: {line_stripped[:30]}")
-                                    
-                                    if not is_auth:
-                                        # Found first non-auth content
-                                        auth_filtering_done = True
-                                        started_response = True
-                                        # Yield this line
-                                        filtered = self._filter_sensitive_paths(line, True)
-                                        yield filtered + '\n'
+                        # Check complete lines for auth until the first response line
+                        consumed = 0
+                        for match in _LINE_RE.finditer(buffer):
+                            consumed = match.end()
+                            line = match.group(1).decode('utf-8', errors='ignore')
+                            if line and not line.isspace() and not is_auth_line(line):
+                                # Found first non-auth content
+                                auth_filtering_done = True
+                                # Yield this line
+                                filtered = self._filter_sensitive_paths(line, True)
+                                yield filtered + '\n'
+                                break
+                        del buffer[:consumed]
                         
                         # If buffer gets too large without newlines, assume no more auth
-                        elif len(buffer) > 500:
+                        if not auth_filtering_done and len(buffer) > 500:
                             auth_filtering_done = True
-                            started_response = True
-                            # Yield accumulated buffer
-                            filtered = self._filter_sensitive_paths(buffer, True)
-                            yield filtered
-                            buffer = ""
+                        
+                        # Once the response has started, pass the rest of this read through in order
+                        if auth_filtering_done and buffer:
+                            text = decoder.decode(buffer)
+                            buffer.clear()
+                            if text:
+                                yield self._filter_sensitive_paths(text, True)
                     else:
                         # Auth filtering done - stream everything immediately
-                        started_response = True
                         # Filter and yield chunk immediately for smooth streaming
+                        text = decoder.decode(chunk)
+                        if not text:
+                            continue
                         filtered_chunk = self._filter_sensitive_paths(text, True)
                         yield filtered_chunk
-                            
-                except asyncio.TimeoutError:
-                    # Check if process is still running
-                    if process.returncode is not None:
-                        break
-                    continue
-            
-            # Yield any remaining buffer
-            if buffer.strip() and started_response:
-                # Only yield if we've started the actual response
-                filtered_buffer = self._filter_sensitive_paths(buffer, True)
-                yield filtered_buffer
-            
-            # Cancel stderr consumer task
-            stderr_task.cancel()
-            try:
-                await stderr_task
-            except asyncio.CancelledError:
-                pass
-            
-            # Wait for process to complete
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.error(f"Qwen CLI timed out after {self.timeout}s")
+                if process.returncode is None:
+                    process.kill()
+            
+            # Yield any remaining unterminated line that is not an auth message
+            if buffer:
+                line = buffer.decode('utf-8', errors='ignore')
+                if line and not line.isspace() and not is_auth_line(line):
+                    yield self._filter_sensitive_paths(line, True)
+            
+            if timed_out:
+                yield f"\n[Error: Qwen CLI timed out after {self.timeout:g}s]"
+            
+            # Wait for process to complete; the stderr consumer finishes at EOF
             await process.wait()
+            await stderr_task
             
-            if process.returncode != 0:
-                # Get any remaining stderr for error reporting
-                stderr_output = await process.stderr.read()
-                error_msg = stderr_output.decode('utf-8', errors='ignore').strip()
+            if process.returncode != 0 and not timed_out:
+                # Use the collected stderr for error reporting
+                error_msg = stderr_buf.decode('utf-8', errors='ignore').strip()
                 if error_msg:
                     logger.error(f"Qwen CLI error: {error_msg}")
                     yield f"\n[Error: {error_msg}]"
                 else:
                     logger.error(f"Qwen CLI exited with code {process.returncode}")
                     yield f"\n[Error: Qwen CLI exited with code {process.returncode}]"
-            
-            # Clean up sandbox (always in sandbox mode)
-            if 'sandbox_dir' in locals():
-                try:
-                    ChatMode.cleanup_sandbox(sandbox_dir)
-                    logger.debug(f"Cleaned up Qwen sandbox: {sandbox_dir}")
-                except Exception as cleanup_error:
-                    logger.warning(f"Failed to cleanup sandbox {sandbox_dir}: {cleanup_error}")
-            
-            # Restore environment variables
-            if original_env:
-                for var, value in original_env.items():
-                    os.environ[var] = value
-                    logger.debug(f"Restored environment variable: {var}")
-            
-            # Clean up debug mode variables we added
-            for var in ['DEBUG', 'DEBUG_MODE', 'VERBOSE', 'NO_COLOR']:
-                if var not in original_env and var in os.environ:
-                    del os.environ[var]
                     
         except Exception as e:
             logger.error(f"Error in Qwen stream_completion: {e}")
             yield f"Error: {str(e)}"
-            
-            # Clean up sandbox on error (always in sandbox mode)
-            if 'sandbox_dir' in locals():
-                try:
-                    ChatMode.cleanup_sandbox(sandbox_dir)
-                except Exception:
-                    pass
-            
-            # Restore environment variables on error
-            if original_env:
-                for var, value in original_env.items():
-                    os.environ[var] = value
-            
-            # Clean up debug mode variables we added
-            for var in ['DEBUG', 'DEBUG_MODE', 'VERBOSE', 'NO_COLOR']:
-                if var not in original_env and var in os.environ:
-                    del os.environ[var]
+        finally:
+            # Single cleanup path for success, errors and client disconnects
+            # (GeneratorExit/CancelledError): don't leave the CLI running
+            if process is not None and process.returncode is None:
+                process.kill()
+            if stderr_task is not None and not stderr_task.done():
+                stderr_task.cancel()
+            # Clean up sandbox (always in sandbox mode)
+            try:
+                sandbox.cleanup()
+                logger.debug("Cleaned up Qwen sandbox")
+            except Exception as cleanup_error:
+                logger.warning(f"Failed to cleanup sandbox: {cleanup_error}")
     
     async def list_models(self) -> List[str]:
         """List available Qwen models from environment variable."""
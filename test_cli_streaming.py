@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Tests for sandbox handling, path filtering and CLI output streaming.
+
+These run without a server or real CLI: a small fake Qwen CLI script is
+written to a temp directory and used in place of the `qwen` binary.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from chat_mode import LazySandbox, filter_sensitive_paths
+from qwen_cli import QwenCLI
+
+SANDBOX_REPLACEMENT = "my secure digital workspace (a sandboxed environment with no file system access)"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def make_fake_cli(directory: str, body: str) -> str:
+    """Write an executable Python script that reads the prompt from stdin and runs body."""
+    path = os.path.join(directory, "fake_qwen")
+    with open(path, "w") as f:
+        f.write(f"#!{sys.executable}\n")
+        f.write("import sys, time\n")
+        f.write("sys.stdin.read()\n")
+        f.write("out = sys.stdout.buffer\n")
+        f.write(body)
+    os.chmod(path, 0o755)
+    return path
+
+
+def run_qwen(body: str, timeout_ms: int = 10000) -> str:
+    """Stream a completion from a fake Qwen CLI and return the joined output."""
+    with tempfile.TemporaryDirectory() as directory:
+        qwen = QwenCLI(timeout=timeout_ms)
+        qwen.qwen_path = make_fake_cli(directory, body)
+
+        async def collect():
+            return "".join([chunk async for chunk in qwen.stream_completion(MESSAGES)])
+
+        return asyncio.run(collect())
+
+
+def test_lazy_sandbox_created_on_first_use():
+    """The sandbox directory only exists once .path is read."""
+    sandbox = LazySandbox()
+    assert not sandbox.created
+    sandbox.cleanup()  # no-op before first use
+    assert not sandbox.created
+
+    path = sandbox.path
+    assert sandbox.created
+    assert os.path.isdir(path)
+    assert sandbox.path == path
+
+    sandbox.cleanup()
+    assert not os.path.exists(path)
+    assert not sandbox.created
+
+
+def test_filter_sensitive_paths_replaces_once():
+    """Each sandbox path becomes one intact replacement, not a re-filtered one."""
+    text = "Working in /tmp/claude_chat_sandbox_abc123 now"
+    assert filter_sensitive_paths(text) == f"Working in {SANDBOX_REPLACEMENT} now"
+
+    text = "cwd: /private/var/folders/ab/cd/T/claude_chat_sandbox_x1 and /tmp/claude_chat_sandbox_y2"
+    filtered = filter_sensitive_paths(text)
+    assert filtered == f"cwd: {SANDBOX_REPLACEMENT} and {SANDBOX_REPLACEMENT}"
+    assert "claude_chat_sandbox" not in filtered
+
+    assert filter_sensitive_paths("Saved to /tmp/build_dir") == "Saved to my secure sandbox environment"
+    # Sequential per-pattern passes used to match the inserted "my" again here
+    text = "Saved to /var/folders/ab/cd//private/var/folders/ef."
+    assert filter_sensitive_paths(text) == "Saved to my secure sandbox environment."
+    assert filter_sensitive_paths("No paths here") == "No paths here"
+
+
+def test_qwen_filters_auth_lines():
+    """Auth-phase noise and blank lines before the response are dropped."""
+    output = run_qwen(
+        "out.write(b'Loaded cached Qwen credentials\\n  \\n[DEBUG] init\\n\\nHello world\\nsecond line\\n')\n"
+    )
+    assert output == "Hello world\nsecond line\n"
+
+
+def test_qwen_single_line_response_without_newline():
+    """A one-line answer with no trailing newline is still returned."""
+    output = run_qwen("out.write(b'[DEBUG] init\\nYes')\n")
+    assert output == "Yes"
+
+
+def test_qwen_multibyte_character_split_across_reads():
+    """A UTF-8 character split across two reads is decoded intact."""
+    output = run_qwen(
+        "out.write(b'Hi\\n'); out.flush(); time.sleep(0.1)\n"
+        "out.write(b'caf\\xc3'); out.flush(); time.sleep(0.1)\n"
+        "out.write(b'\\xa9 ok\\n')\n"
+    )
+    assert output == "Hi\ncafé ok\n"
+
+
+def test_qwen_overall_stream_deadline():
+    """Steady output doesn't extend the timeout: the stream as a whole is bounded."""
+    start = time.monotonic()
+    output = run_qwen(
+        "while True:\n"
+        "    out.write(b'tick\\n'); out.flush(); time.sleep(0.05)\n",
+        timeout_ms=500,
+    )
+    assert time.monotonic() - start < 5
+    assert output.startswith("tick\n")
+    assert output.endswith("\n[Error: Qwen CLI timed out after 0.5s]")
+
+
+if __name__ == "__main__":
+    tests = [
+        test_lazy_sandbox_created_on_first_use,
+        test_filter_sensitive_paths_replaces_once,
+        test_qwen_filters_auth_lines,
+        test_qwen_single_line_response_without_newline,
+        test_qwen_multibyte_character_split_across_reads,
+        test_qwen_overall_stream_deadline,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
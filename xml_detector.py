@@ -9,6 +9,10 @@ from typing import List, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Every positively scored pattern in calculate_confidence() needs one of these
+# (a tag, "tool" or "XML"); without them the score can never reach the threshold
+_XML_SIGNAL_RE = re.compile(r'<|tool|xml', re.IGNORECASE)
+
 
 class XMLDetector:
     """Confidence-based XML detection for nuanced scenarios."""
@@ -185,11 +189,27 @@ class XMLDetector:
         
         return confidence_score, detected_patterns
     
+    def _has_xml_signal(self, messages: List[Dict]) -> bool:
+        """Check whether any message text could contribute a positive score."""
+        for msg in messages:
+            if isinstance(msg, dict):
+                content = msg.get('content', '')
+            else:
+                content = getattr(msg, 'content', '')
+            if isinstance(content, str) and _XML_SIGNAL_RE.search(content):
+                return True
+        return False
+    
     def detect(self, messages: List[Dict]) -> Tuple[bool, float, List[str]]:
         """
         Detect XML requirement with confidence scoring.
         Returns: (requires_xml, confidence_score, detected_patterns)
         """
+        # Cheap prefilter: plain chat without any XML/tool signal can't score
+        if not self._has_xml_signal(messages):
+            logger.debug("Confidence-based detection: No XML/tool signal, skipping scoring")
+            return False, 0.0, []
+        
         # First check if it's primarily a code discussion
         if self.is_primarily_code_discussion(messages):
             logger.debug("Confidence-based detection: Primarily code discussion, skipping XML enforcement")
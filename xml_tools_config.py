@@ -5,11 +5,30 @@ Allows users to specify known XML tools via environment variable.
 
 import os
 import logging
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=8)
+def _parse_known_xml_tools(tools_env: str) -> Tuple[str, ...]:
+    """Parse the XML_KNOWN_TOOLS value (cached per distinct value)."""
+    if not tools_env:
+        logger.debug("XML_KNOWN_TOOLS not set or empty - no tools will be detected")
+        return ()
+    
+    # Parse comma-separated values, trim whitespace, convert to lowercase
+    tools = tuple(tool.strip().lower() for tool in tools_env.split(',') if tool.strip())
+    
+    if tools:
+        logger.debug(f"Configured XML tools: {list(tools)}")
+    else:
+        logger.debug("XML_KNOWN_TOOLS is set but contains no valid tools")
+    
+    return tools
+
+
 def get_known_xml_tools() -> List[str]:
     """
     Get list of known XML tools from environment variable.
@@ -18,24 +37,13 @@ def get_known_xml_tools() -> List[str]:
     Environment variable format:
     XML_KNOWN_TOOLS="attempt_completion,ask_followup_question,read_file,write_to_file"
     
+    Parsing is cached on the raw variable value, so repeated calls only cost
+    an environment lookup while runtime changes are still picked up.
+    
     Returns:
         List of tool names (lowercase, trimmed)
     """
-    tools_env = os.getenv('XML_KNOWN_TOOLS', '')
-    
-    if not tools_env:
-        logger.debug("XML_KNOWN_TOOLS not set or empty - no tools will be detected")
-        return []
-    
-    # Parse comma-separated values, trim whitespace, convert to lowercase
-    tools = [tool.strip().lower() for tool in tools_env.split(',') if tool.strip()]
-    
-    if tools:
-        logger.debug(f"Configured XML tools: {tools}")
-    else:
-        logger.debug("XML_KNOWN_TOOLS is set but contains no valid tools")
-    
-    return tools
+    return list(_parse_known_xml_tools(os.getenv('XML_KNOWN_TOOLS', '')))
 
 
 def is_known_xml_tool(tool_name: str) -> bool:
@@ -48,5 +56,4 @@ def is_known_xml_tool(tool_name: str) -> bool:
     Returns:
         True if tool is known, False otherwise
     """
-    known_tools = get_known_xml_tools()
-    return tool_name.lower() in known_tools
\ No newline at end of file
+    return tool_name.lower() in _parse_known_xml_tools(os.getenv('XML_KNOWN_TOOLS', ''))
\ No newline at end of file